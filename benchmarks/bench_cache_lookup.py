@@ -0,0 +1,97 @@
+"""Задержка get_cached_versions на большом кэше: индекс normalized_url против полного обхода.
+
+Запуск из корня репозитория: python benchmarks/bench_cache_lookup.py [--entries 100000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_bot
+
+
+def make_entries(count):
+    """Записи кэша: по две версии на видео, у каждой есть file_id (без обращения к диску)"""
+    entries = []
+    for index in range(count):
+        video_id = f"{index // 2:011d}"
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        format_key = 'best' if index % 2 else 'video:22'
+        entries.append({
+            'url_hash': yt_bot.get_cache_key(url, format_key),
+            'url': url,
+            'normalized_url': yt_bot.normalize_url(url),
+            'video_id': video_id,
+            'file_path': None,
+            'format_id': None if index % 2 else '22',
+            'title': f"Video {video_id}",
+            'url_type': 'youtube',
+            'cached_date': time.time(),
+            'format_key': format_key,
+            'file_id': f"file-{index}",
+        })
+    return entries
+
+
+def legacy_lookup(entries, url):
+    """Прежний get_cached_versions: нормализация каждого сохраненного URL при каждом запросе"""
+    normalized_url = yt_bot.normalize_url(url)
+    return [entry for entry in entries if yt_bot.normalize_url(entry['url']) == normalized_url]
+
+
+def measure(lookup, urls):
+    """Задержки вызовов lookup в микросекундах"""
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        lookup(url)
+        latencies.append((time.perf_counter() - started) * 1e6)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:10s} запросов {len(latencies):6d}  среднее {statistics.mean(latencies):10.1f} мкс  "
+          f"медиана {statistics.median(latencies):10.1f} мкс  p99 {p99:10.1f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100_000, help="записей в кэше")
+    parser.add_argument('--lookups', type=int, default=10_000, help="запросов к индексу")
+    parser.add_argument('--legacy-lookups', type=int, default=20, help="запросов полным обходом (0 — пропустить)")
+    args = parser.parse_args()
+
+    random.seed(1)
+    entries = make_entries(args.entries)
+    videos = args.entries // 2
+    # Половина запросов — видео из кэша, половина — промахи
+    urls = [
+        f"https://youtu.be/{random.randrange(videos):011d}" if i % 2 else f"https://youtu.be/x{i:010d}"
+        for i in range(args.lookups)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = yt_bot.VideoCacheStore(os.path.join(tmp_dir, 'video_cache.db'))
+        started = time.perf_counter()
+        with store.lock, store.conn:
+            for entry in entries:
+                store._insert(entry)
+            store._rebuild_stats()
+        print(f"Кэш: {store.count()} записей, заполнен за {time.perf_counter() - started:.1f} сек")
+        yt_bot.video_cache_store = store
+
+        report('индекс', measure(yt_bot.get_cached_versions, urls))
+        if args.legacy_lookups:
+            report('обход', measure(lambda url: legacy_lookup(entries, url), urls[:args.legacy_lookups]))
+        store.conn.close()
+
+
+if __name__ == '__main__':
+    main()
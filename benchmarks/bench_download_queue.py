@@ -0,0 +1,85 @@
+"""Стоимость операций DownloadQueue при росте числа заданий и потоков (пользователей).
+
+put, get и position не зависят от общего числа заданий: put и get — O(log потоков)
+(плюс вставка в список потока), position — O(потоков). dispatch_order сортирует всю очередь
+и нужен только /queue для прогноза ETA.
+
+Запуск из корня репозитория: python benchmarks/bench_download_queue.py
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_bot
+
+# (заданий, потоков)
+CASES = [
+    (200, 20),
+    (2000, 20),
+    (2000, 500),
+    (20000, 500),
+]
+
+
+class FixedCostModel:
+    def predict(self, task):
+        return random.choice([10.0, 60.0, 600.0])
+
+
+def fill_queue(jobs, flows):
+    queue = yt_bot.DownloadQueue(yt_bot.DOWNLOAD_WORKERS, 1, jobs, 0, 0, FixedCostModel(), yt_bot.SCHEDULER_AGING_FACTOR)
+    started = time.perf_counter()
+    for index in range(jobs):
+        task = yt_bot.DownloadTask(
+            index % flows, f"https://youtu.be/{index:0>11}", 'best', None, 'youtube', None, False
+        )
+        queue.put(task, admission=False)
+    return queue, (time.perf_counter() - started) / jobs
+
+
+def per_call(func, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - started) / calls
+
+
+def run_case(jobs, flows, samples):
+    random.seed(1)
+    queue, put_time = fill_queue(jobs, flows)
+    job_ids = random.sample(list(queue.jobs), min(samples, jobs))
+    position_time = per_call(lambda: queue.position(random.choice(job_ids)), samples)
+    order_time = per_call(queue.dispatch_order, 5)
+
+    async def drain():
+        started = time.perf_counter()
+        for _ in range(samples):
+            job = await queue.get()
+            queue.done(job.job_id)
+        return (time.perf_counter() - started) / samples
+
+    get_time = asyncio.run(drain())
+    return put_time, get_time, position_time, order_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=200, help="вызовов get и position на случай")
+    args = parser.parse_args()
+
+    print(f"{'заданий':>8} {'потоков':>8} {'put, мкс':>9} {'get, мкс':>9} {'position, мкс':>14} {'dispatch_order, мс':>19}")
+    for jobs, flows in CASES:
+        put_time, get_time, position_time, order_time = run_case(jobs, flows, args.samples)
+        print(
+            f"{jobs:8d} {flows:8d} {put_time * 1e6:9.1f} {get_time * 1e6:9.1f} "
+            f"{position_time * 1e6:14.1f} {order_time * 1e3:19.2f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Число загрузок каналов и время одного цикла проверки подписок при росте числа пользователей и каналов.
+
+Сравнивает SubscriptionPoller (один запрос на канал) с прежней схемой, где у каждого
+пользователя своя задача и свой запрос на каждую подписку. Загрузка канала заменена
+задержкой --fetch-latency через пул из --workers потоков, как у пула метаданных.
+Сохранение состояния настоящее, кроме записи на диск: отдельно показано, сколько цикл
+событий тратит на снимок данных, который StatePersister снимает раз за интервал сброса.
+
+Запуск из корня репозитория: python benchmarks/bench_subscription_poller.py [--skip-legacy]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_bot
+
+# (пользователей, каналов, подписок на пользователя)
+CASES = [
+    (100, 20, 3),
+    (1000, 20, 3),
+    (5000, 50, 3),
+    (5000, 500, 5),
+]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, **kwargs):
+        self.sent += 1
+
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+class FakeFetcher:
+    """Заменяет загрузку последних видео канала: фиксированная задержка в ограниченном пуле"""
+
+    def __init__(self, latency, workers):
+        self.latency = latency
+        self.workers = workers
+        self.semaphore = None
+        self.calls = 0
+
+    async def latest_videos(self, channel_url, max_results=5):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        self.calls += 1
+        async with self.semaphore:
+            await asyncio.sleep(self.latency)
+        # У каждого канала одно новое видео с прошлой проверки
+        return [
+            {'id': f"{channel_url}-new", 'title': 'New', 'url': f"{channel_url}/new", 'duration': 60},
+            {'id': f"{channel_url}-old", 'title': 'Old', 'url': f"{channel_url}/old", 'duration': 60},
+        ]
+
+
+def make_subscriptions(users, channels, per_user):
+    random.seed(1)
+    subscriptions = {}
+    for user in range(users):
+        for channel in random.sample(range(channels), per_user):
+            subscriptions.setdefault(str(user), {})[f"sub_{channel}"] = {
+                'channel_id': f"channel-{channel}",
+                'url': f"channel-{channel}",
+                'title': f"Channel {channel}",
+                'subscription_date': 0,
+                'last_check': 0,
+                'last_video_id': f"channel-{channel}-old",
+                'notifications_enabled': True,
+            }
+    return subscriptions
+
+
+async def legacy_cycle(fetcher, app):
+    """Прежняя схема: задача на пользователя, последовательный запрос на каждую подписку"""
+    async def check_user(user_subscriptions):
+        for sub_data in list(user_subscriptions.values()):
+            await fetcher.latest_videos(sub_data['url'], 5)
+
+    await asyncio.gather(*(check_user(user_subscriptions) for user_subscriptions in yt_bot.subscriptions.values()))
+
+
+async def poller_cycle(fetcher, app):
+    """Один цикл SubscriptionPoller: каждый канал загружается один раз, видео рассылаются подписчикам"""
+    poller = yt_bot.SubscriptionPoller(
+        yt_bot.CHECK_INTERVAL, yt_bot.SUBSCRIPTION_MIN_INTERVAL, yt_bot.SUBSCRIPTION_MAX_INTERVAL, 0,
+        yt_bot.SUBSCRIPTION_POLLS_PER_MINUTE, yt_bot.SUBSCRIPTION_FETCH_CONCURRENCY, 0,
+        yt_bot.feed_client, yt_bot.FEED_SEEN_IDS,
+    )
+    poller.rebuild()
+    semaphore = asyncio.Semaphore(poller.concurrency)
+    await asyncio.gather(*(poller.poll_channel(app, key, semaphore) for key in list(poller.channels)))
+
+
+def run_case(cycle, users, channels, per_user, args):
+    yt_bot.subscriptions.clear()
+    yt_bot.subscriptions.update(make_subscriptions(users, channels, per_user))
+    yt_bot.channel_state.clear()
+    fetcher = FakeFetcher(args.fetch_latency, args.workers)
+    yt_bot.metadata_service.latest_videos = fetcher.latest_videos
+    app = FakeApp()
+
+    started = time.perf_counter()
+    asyncio.run(cycle(fetcher, app))
+    elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    yt_bot.state_persister.take_snapshots()
+    snapshot = time.perf_counter() - started
+    return fetcher.calls, elapsed, app.bot.sent, snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fetch-latency', type=float, default=0.02, help="задержка загрузки канала, сек")
+    parser.add_argument('--workers', type=int, default=yt_bot.METADATA_WORKERS, help="потоков пула метаданных")
+    parser.add_argument('--skip-legacy', action='store_true', help="не запускать прежнюю схему (она медленная)")
+    args = parser.parse_args()
+
+    # Поток StatePersister не запускается: save_*() только помечают файлы, снимок снимается в run_case
+    print(
+        f"{'польз.':>7} {'каналов':>8} {'подп.':>6} {'схема':>8} {'загрузок':>9} {'время, с':>9} "
+        f"{'уведомл.':>9} {'снимок, мс':>11}"
+    )
+    for users, channels, per_user in CASES:
+        cycles = [('poller', poller_cycle)] if args.skip_legacy else [('прежняя', legacy_cycle), ('poller', poller_cycle)]
+        for name, cycle in cycles:
+            calls, elapsed, sent, snapshot = run_case(cycle, users, channels, per_user, args)
+            print(
+                f"{users:7d} {channels:8d} {per_user:6d} {name:>8} {calls:9d} {elapsed:9.2f} "
+                f"{sent:9d} {snapshot * 1000:11.1f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Задания, прерванные остановкой бота, остаются в журнале очереди"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("yt_dlp")
+
+import yt_bot
+
+
+@pytest.fixture
+def journaled_queue(monkeypatch, tmp_path):
+    """Пустая очередь с журналом во временной директории; обработчики и фоновые задачи — свои"""
+    queue = yt_bot.DownloadQueue(1, 1, 5, 0, 0, yt_bot.job_cost_model, 0)
+    journal = yt_bot.JobJournal(str(tmp_path / "queue.db"))
+    queue.attach_journal(journal)
+    monkeypatch.setattr(yt_bot, 'download_queue', queue)
+    monkeypatch.setattr(yt_bot, 'download_workers', {})
+    monkeypatch.setattr(yt_bot, 'background_tasks', [])
+    monkeypatch.setattr(yt_bot, 'DOWNLOAD_DIR', str(tmp_path / "downloads"))
+    return queue, journal
+
+
+def test_shutdown_keeps_running_job_in_journal(journaled_queue, monkeypatch):
+    queue, journal = journaled_queue
+    started = asyncio.Event()
+
+    async def process_download_task(app, task, work_dir, job=None):
+        started.set()
+        await asyncio.Event().wait()  # Загрузка, которую прерывает остановка бота
+
+    monkeypatch.setattr(yt_bot, 'process_download_task', process_download_task)
+
+    async def run():
+        task = yt_bot.DownloadTask(1, "https://youtu.be/abcdefghijk", 'best', None, 'youtube', None, False)
+        job = queue.put(task)
+        yt_bot.start_download_worker(None, 0)
+        await started.wait()
+        await yt_bot.stop_background_tasks(None)
+        return job
+
+    job = asyncio.run(run())
+
+    assert job.cancel_event.is_set()
+    assert not queue.running
+    rows = journal.all_rows()
+    assert len(rows) == 1
+    # Остановка бота не считается неудачной попыткой
+    assert rows[0][-1] == 0
@@ -0,0 +1,77 @@
+"""Порядок выдачи заданий очередью загрузок"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("yt_dlp")
+
+import yt_bot
+
+
+def make_queue(workers=3, max_running_per_flow=1):
+    return yt_bot.DownloadQueue(workers, max_running_per_flow, 10, 0, 0, yt_bot.job_cost_model, 0)
+
+
+def make_task(user_id, video):
+    return yt_bot.DownloadTask(user_id, f"https://youtu.be/{video:0>11}", 'best', None, 'youtube', None, False)
+
+
+def take(queue, count):
+    """Извлекает count заданий, как это сделали бы свободные обработчики"""
+    async def get_all():
+        return [await asyncio.wait_for(queue.get(), 1) for _ in range(count)]
+
+    return asyncio.run(get_all())
+
+
+def test_single_user_uses_all_free_workers():
+    queue = make_queue()
+    for video in range(3):
+        queue.put(make_task(1, video))
+
+    jobs = take(queue, 3)
+
+    assert len(jobs) == 3
+    assert queue.empty()
+
+
+def test_flow_limit_prefers_other_users():
+    queue = make_queue()
+    queue.put(make_task(1, 1))
+    queue.put(make_task(1, 2))
+    queue.put(make_task(2, 3))
+
+    first, second = take(queue, 2)
+
+    # Пока у второго пользователя есть задание, первый не получает второй обработчик
+    assert (first.user_id, second.user_id) == (1, 2)
+
+
+def test_peek_and_remove_do_not_disturb_other_jobs():
+    queue = make_queue()
+    first = queue.put(make_task(1, 1))
+    second = queue.put(make_task(2, 2))
+
+    assert queue.peek() is first
+    assert queue.qsize() == 2
+
+    assert queue.remove(first.job_id)
+    assert not queue.remove(first.job_id)
+    assert first.state == yt_bot.JOB_CANCELLED
+    assert queue.peek() is second
+    # Запрос того же видео после удаления создает новое задание
+    assert queue.put(make_task(3, 1)) is not first
+
+
+def test_position_matches_dispatch_order():
+    queue = make_queue()
+    for video in range(12):
+        queue.put(make_task(video % 4, video))
+    take(queue, 2)
+
+    order = queue.dispatch_order()
+
+    assert [queue.position(job_id) for job_id in order] == list(range(1, len(order) + 1))
+    # Следующее выдаваемое задание — первое в прогнозе порядка
+    assert queue.peek().job_id == order[0]
@@ -0,0 +1,155 @@
+"""Проверка подписок через RSS-ленту канала на локальном HTTP-сервере"""
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("yt_dlp")
+pytest.importorskip("httpx")
+
+import yt_bot
+
+CHANNEL_ID = 'UC' + 'a' * 22
+
+
+def feed_xml(video_ids):
+    entries = ''.join(
+        f'<entry><yt:videoId>{video_id}</yt:videoId><title>Видео {video_id}</title>'
+        f'<link rel="alternate" href="https://www.youtube.com/watch?v={video_id}"/>'
+        f'<published>2026-10-01T10:00:00+00:00</published></entry>'
+        for video_id in video_ids
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" '
+        'xmlns:media="http://search.yahoo.com/mrss/" xmlns="http://www.w3.org/2005/Atom">'
+        f'{entries}</feed>'
+    ).encode()
+
+
+class FeedServer:
+    """Заменитель youtube.com/feeds: отдает ленту с ETag и отвечает 304 на совпавший If-None-Match"""
+
+    def __init__(self):
+        self.video_ids = []
+        self.responses = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                etag = '"' + '-'.join(server.video_ids) + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    server.responses.append(304)
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = feed_xml(server.video_ids)
+                server.responses.append(200)
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url_template = f"http://127.0.0.1:{self.httpd.server_port}/feeds/videos.xml?channel_id={{channel_id}}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def feed_server():
+    with FeedServer() as server:
+        yield server
+
+
+@pytest.fixture
+def notifications(monkeypatch):
+    """Отправленные уведомления: [(user_id, video_id)]; сохранение на диск и yt-dlp отключены"""
+    sent = []
+
+    async def send_video_notification(app, user_id, sub_id, sub_data, video):
+        sent.append((user_id, video['id']))
+        return True
+
+    async def latest_videos(url, count):
+        raise AssertionError("при доступной ленте yt-dlp не используется")
+
+    monkeypatch.setattr(yt_bot, 'send_video_notification', send_video_notification)
+    monkeypatch.setattr(yt_bot.metadata_service, 'latest_videos', latest_videos)
+    monkeypatch.setattr(yt_bot, 'save_subscriptions', lambda: None)
+    monkeypatch.setattr(yt_bot, 'save_channel_state', lambda: None)
+    monkeypatch.setattr(yt_bot, 'channel_state', {})
+    return sent
+
+
+def make_subscription(last_video_id):
+    return {
+        'channel_id': CHANNEL_ID,
+        'url': f"https://www.youtube.com/channel/{CHANNEL_ID}",
+        'title': 'Канал',
+        'last_check': 0,
+        'last_video_id': last_video_id,
+        'notifications_enabled': True,
+    }
+
+
+def run_polls(feed_server, monkeypatch, subscriptions, steps):
+    """Проверяет канал по шагам: steps — список лент [video_ids], по одной проверке на каждую"""
+    monkeypatch.setattr(yt_bot, 'subscriptions', subscriptions)
+    client = yt_bot.ChannelFeedClient(feed_server.url_template, 5, 2)
+    poller = yt_bot.SubscriptionPoller(3600, 300, 43200, 0.1, 30, 2, 0, client, 10)
+    poller.rebuild()
+
+    async def poll_all():
+        semaphore = asyncio.Semaphore(1)
+        try:
+            for video_ids in steps:
+                feed_server.video_ids = video_ids
+                await poller.poll_channel(None, CHANNEL_ID, semaphore)
+        finally:
+            await client.close()
+
+    asyncio.run(poll_all())
+    return client
+
+
+def test_feed_not_modified_and_new_entry(feed_server, monkeypatch, notifications):
+    subscriptions = {'1': {'s1': make_subscription('v1')}}
+    client = run_polls(feed_server, monkeypatch, subscriptions, [
+        ['v1'],
+        ['v1'],
+        ['v2', 'v1'],
+    ])
+
+    assert feed_server.responses == [200, 304, 200]
+    assert client.get_stats() == {'requests': 3, 'not_modified': 1, 'failures': 0}
+    assert client.client is None
+    # Уведомление только о появившемся в ленте видео, и только один раз
+    assert notifications == [('1', 'v2')]
+    assert subscriptions['1']['s1']['last_video_id'] == 'v2'
+    assert yt_bot.channel_state[CHANNEL_ID]['etag'] == '"v2-v1"'
+
+
+def test_first_check_uses_each_subscriber_marker(feed_server, monkeypatch, notifications):
+    subscriptions = {
+        '1': {'s1': make_subscription('v1')},
+        '2': {'s2': make_subscription('v3')},
+    }
+    run_polls(feed_server, monkeypatch, subscriptions, [['v3', 'v2', 'v1']])
+
+    # Подписчик, отставший на два видео, получает оба; второму новых видео нет
+    assert sorted(notifications) == [('1', 'v2'), ('1', 'v3')]
+    assert subscriptions['1']['s1']['last_video_id'] == 'v3'
+    assert subscriptions['2']['s2']['last_video_id'] == 'v3'
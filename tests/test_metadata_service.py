@@ -0,0 +1,98 @@
+"""Цикл событий не блокируется, пока yt-dlp извлекает метаданные"""
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("yt_dlp")
+
+import yt_bot
+
+EXTRACTION_SECONDS = 0.5
+EXTRACTIONS = 4
+# Верхняя граница задержки одного тика цикла событий во время извлечения
+MAX_TICK_LATENCY = 0.1
+
+
+@pytest.fixture
+def blocking_extraction(monkeypatch):
+    """Извлечение метаданных заменено блокирующим sleep, кэш и лимит запросов отключены"""
+    def get_video_info(url, url_type):
+        time.sleep(EXTRACTION_SECONDS)
+        return {'id': url, 'title': url}
+
+    async def acquire(platform):
+        return None
+
+    monkeypatch.setattr(yt_bot, 'get_video_info', get_video_info)
+    monkeypatch.setattr(yt_bot, 'get_cached_video_info', lambda url: None)
+    monkeypatch.setattr(yt_bot.rate_limiter, 'acquire', acquire)
+
+
+async def measure_ticks(coro, interval=0.01):
+    """Выполняет coro и возвращает (результат, задержки тиков цикла событий за это время)"""
+    ticks = []
+
+    async def ticker():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            ticks.append(now - last - interval)
+            last = now
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        result = await coro
+    finally:
+        ticker_task.cancel()
+    return result, ticks
+
+
+def test_event_loop_responsive_during_extraction(blocking_extraction):
+    executor = yt_bot.BoundedExecutor('test-metadata', EXTRACTIONS, EXTRACTIONS, 5)
+    service = yt_bot.MetadataService(executor)
+
+    async def extract_all():
+        return await asyncio.gather(*(service.video_info(f"video-{i}", 'youtube') for i in range(EXTRACTIONS)))
+
+    started = time.perf_counter()
+    results, ticks = asyncio.run(measure_ticks(extract_all()))
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+
+    assert [info['id'] for info in results] == [f"video-{i}" for i in range(EXTRACTIONS)]
+    # Извлечения идут параллельно в пуле, а не по очереди в цикле событий
+    assert elapsed < EXTRACTION_SECONDS * 2
+    assert ticks and max(ticks) < MAX_TICK_LATENCY
+
+
+def test_timeout_does_not_block_loop(blocking_extraction):
+    executor = yt_bot.BoundedExecutor('test-metadata', 1, 1, EXTRACTION_SECONDS / 5)
+    service = yt_bot.MetadataService(executor)
+
+    async def extract():
+        with pytest.raises(asyncio.TimeoutError):
+            await service.video_info("video", 'youtube')
+
+    _, ticks = asyncio.run(measure_ticks(extract()))
+    executor.shutdown()
+
+    assert executor.timeouts == 1
+    assert max(ticks) < MAX_TICK_LATENCY
+
+
+def test_info_cache_bounded_by_size():
+    cache = yt_bot.VideoInfoCache(600, 100, 2500, 60)
+    for key in ("a", "b", "c"):
+        cache.get_or_extract(key, lambda: yt_bot.trim_video_info(
+            {'id': key, 'formats': [{'url': 'x' * 1000}], 'automatic_captions': {'en': ['y' * 100000]}}
+        ))
+
+    stats = cache.get_stats()
+    # Субтитры не хранятся, а самая старая запись вытеснена по объему
+    assert stats['entries'] == 2
+    assert stats['bytes'] <= 2500
+    assert cache.peek("a") is None
+    assert 'automatic_captions' not in cache.peek("c")
@@ -0,0 +1,68 @@
+"""Кэш видео: отдельные файлы версий и статистика попаданий"""
+import os
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("yt_dlp")
+
+import yt_bot
+
+URL = "https://www.youtube.com/watch?v=abcdefghijk"
+
+
+@pytest.fixture
+def video_cache(monkeypatch, tmp_path):
+    """Пустой кэш видео во временной директории"""
+    cache_dir = tmp_path / "video_cache"
+    cache_dir.mkdir()
+    store = yt_bot.VideoCacheStore(str(tmp_path / "cache.db"))
+    monkeypatch.setattr(yt_bot, 'CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(yt_bot, 'video_cache_store', store)
+    return store
+
+
+def download(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def test_versions_of_one_video_keep_separate_files(video_cache, tmp_path):
+    best_path = yt_bot.add_to_video_cache(
+        URL, download(tmp_path, "Title.mp4", 100), None, "best", 60, "Title", 'youtube', 'best'
+    )
+    format_path = yt_bot.add_to_video_cache(
+        URL, download(tmp_path, "Title.mp4", 300), "22", "720p", 60, "Title", 'youtube', 'video:22'
+    )
+
+    assert best_path != format_path
+    assert os.path.getsize(best_path) == 100
+    assert os.path.getsize(format_path) == 300
+    assert video_cache.usage() == (400, 2)
+
+
+def test_recached_version_replaces_its_file(video_cache, tmp_path):
+    first_path = yt_bot.add_to_video_cache(
+        URL, download(tmp_path, "Title.mp4", 100), None, "best", 60, "Title", 'youtube', 'best'
+    )
+    second_path = yt_bot.add_to_video_cache(
+        URL, download(tmp_path, "Title.mp4", 200), None, "best", 60, "Title", 'youtube', 'best'
+    )
+
+    assert first_path == second_path
+    assert os.listdir(yt_bot.CACHE_DIR) == [os.path.basename(second_path)]
+    assert video_cache.usage() == (200, 1)
+
+
+def test_hits_and_misses_counted_once_per_lookup(video_cache, tmp_path):
+    assert yt_bot.get_cached_versions(URL) == []
+    yt_bot.add_to_video_cache(URL, download(tmp_path, "Title.mp4", 100), None, "best", 60, "Title", 'youtube', 'best')
+    assert len(yt_bot.get_cached_versions(URL)) == 1
+
+    # Проверка кэша обработчиком очереди не меняет статистику попаданий
+    task = yt_bot.DownloadTask(1, URL, 'video', '22', 'youtube', None, False)
+    assert yt_bot.get_task_cache_entry(task) is None
+
+    stats = video_cache.get_stats()
+    assert (stats.get('hits', 0), stats.get('misses', 0)) == (1, 1)
@@ -14,15 +14,25 @@ import random
 import secrets
 import string
 import urllib.parse
+import copy
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import itertools
+import sqlite3
+import heapq
+import bisect
+import math
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram import Update, Message, Chat, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     filters, ContextTypes, InlineQueryHandler, ConversationHandler
 )
 from telegram.error import NetworkError, RetryAfter, TimedOut, BadRequest
+import httpx
 import yt_dlp
 
 # Настройка логирования
@@ -38,17 +48,85 @@ ADMIN_ID = "12345678"  # Ваш ID в Telegram
 # Глобальные словари
 inline_query_cache = {}
 user_videos = {}
-user_data = {}
+user_store = None
 user_searches = {}
-download_queue = asyncio.Queue()
-queue_status = {}
-queue_processing = False  # Флаг обработки очереди
-download_executor = ThreadPoolExecutor(max_workers=3)
+# Количество одновременных загрузок: обработчики очереди и потоки для yt-dlp
+DOWNLOAD_WORKERS = 3
+DOWNLOAD_DIR = "downloads"
+# Журнал заданий очереди, чтобы они переживали перезапуск бота
+QUEUE_DB_FILE = "download_queue.db"
+# Сколько раз задание может прерываться перезапуском, прежде чем его отбросят
+MAX_JOB_RETRIES = 3
+# Справедливая очередь: одновременных загрузок на пользователя (чат для групп)
+# и незавершенных заданий на пользователя
+MAX_RUNNING_PER_USER = 1
+MAX_OUTSTANDING_PER_USER = 10
+# Контроль допуска: размер очереди и прогнозируемое ожидание в секундах (0 — без ограничения).
+# Меняются администратором командой /limits
+MAX_QUEUE_SIZE = 200
+MAX_QUEUE_WAIT = 1800
+# Модель стоимости заданий: начальные оценки скоростей (байт/с), пока нет статистики
+DEFAULT_DOWNLOAD_SPEED = 2 * 1024 * 1024
+DEFAULT_UPLOAD_SPEED = 1024 * 1024
+DEFAULT_JOB_SIZE = 20 * 1024 * 1024
+JOB_OVERHEAD_SECONDS = 5
+THROUGHPUT_SMOOTHING = 0.2
+# Старение: сколько секунд прогнозируемой длительности списывается заданию за секунду ожидания
+SCHEDULER_AGING_FACTOR = 1.0
+download_workers = {}
+# Фоновые задачи бота (проверка подписок, очистка кэша), отменяются при остановке
+background_tasks = []
 USER_DATA_FILE = "user_data.json"
+USER_DB_FILE = "user_data.db"
+ACTIVE_USER_DAYS = 7
+TOP_DOWNLOADERS_LIMIT = 5
+# Как часто обновлять время последней активности пользователя (секунды)
+LAST_SEEN_RESOLUTION = 300
 
 
 CACHE_FILE = "video_cache.json"
+CACHE_DB_FILE = "video_cache.db"
 CACHE_DIR = "video_cache"
+video_cache_store = None
+
+# Квота на кэш на диске (0 — без ограничения) и политика вытеснения: lru, lfu или size
+CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+CACHE_MAX_ENTRIES = 5000
+CACHE_EVICTION_POLICY = 'lru'
+CACHE_REAPER_INTERVAL = 600
+
+# Кэш метаданных (extract_info): время жизни, размер и время жизни записей об ошибках
+METADATA_CACHE_TTL = 600
+METADATA_CACHE_MAX_ENTRIES = 500
+# Ограничение объема кэша метаданных по приблизительному размеру записей (длина JSON)
+METADATA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Поля info, которые бот не использует и которые не нужны yt-dlp для загрузки; занимают большую часть объема
+METADATA_DROP_FIELDS = (
+    'automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap', 'thumbnails', 'chapters', 'description',
+)
+METADATA_NEGATIVE_TTL = 60
+# Запас времени до истечения ссылок форматов, при котором info еще можно использовать для загрузки
+INFO_EXPIRY_MARGIN = 300
+STALE_FORMAT_ERRORS = ('HTTP Error 403', 'HTTP Error 410', 'expired')
+# Пул потоков для извлечения метаданных (видео, каналы) и таймаут одного вызова, секунды (см. EXECUTOR_LIMITS)
+METADATA_WORKERS = 4
+METADATA_TIMEOUT = 45
+
+# Ограничение частоты запросов к платформам: (запросов в секунду, размер всплеска)
+RATE_LIMITS = {
+    'youtube': (0.5, 3),
+    'youtube_music': (0.5, 3),
+    'tiktok': (0.3, 2),
+}
+DEFAULT_RATE_LIMIT = (0.5, 3)
+# Случайная добавка к вынужденному ожиданию, секунды
+RATE_LIMIT_JITTER = 1.0
+# После HTTP 429 скорость снижается в RATE_LIMIT_BACKOFF раз (не более чем в RATE_LIMIT_MAX_PENALTY)
+# и восстанавливается с полупериодом RATE_LIMIT_RECOVERY секунд
+RATE_LIMIT_BACKOFF = 2
+RATE_LIMIT_MAX_PENALTY = 16
+RATE_LIMIT_RECOVERY = 300
+RATE_LIMIT_ERRORS = ('HTTP Error 429', 'Too Many Requests')
 
 COOKIES_FILES = [
     "cookies.txt",
@@ -57,19 +135,93 @@ COOKIES_FILES = [
     os.path.expanduser("~/.config/youtube-dl/cookies.txt"),
 ]
 
+# Общие настройки yt-dlp для загрузок, поиска и метаданных
+YDL_BASE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    # Добавляем параметры для работы с SSL
+    'no_check_certificate': True,
+    'socket_timeout': 30,
+    'source_address': '0.0.0.0',
+}
+MP3_POSTPROCESSOR = {
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'mp3',
+    'preferredquality': '192',
+}
+# Профили пула YoutubeDL; папку загрузки, формат и хук прогресса задает каждое задание
+YDL_PROFILES = {
+    'info': {**YDL_BASE_OPTS, 'extract_flat': False},
+    'video': {**YDL_BASE_OPTS, 'outtmpl': '%(title)s.%(ext)s'},
+    'audio': {**YDL_BASE_OPTS, 'format': 'bestaudio/best', 'outtmpl': '%(title)s.%(ext)s',
+              'postprocessors': [MP3_POSTPROCESSOR]},
+    'search': {**YDL_BASE_OPTS, 'extract_flat': True, 'skip_download': True},
+    'channel': {'quiet': True, 'no_warnings': True, 'extract_flat': True, 'skip_download': True},
+}
+# Экземпляр YoutubeDL пересоздается после стольких вызовов (и после любой ошибки)
+YDL_MAX_USES = 50
+
+# Платформы, для которых подставляются cookies
+COOKIES_URL_TYPES = ('youtube', 'youtube_music')
+
 SUBSCRIPTIONS_FILE = "subscriptions.json"
+# Интервал проверки канала, пока о его загрузках ничего не известно, секунды
 CHECK_INTERVAL = 3600
+# Интервал подстраивается под канал, но остается в этих пределах, секунды
+SUBSCRIPTION_MIN_INTERVAL = 300
+SUBSCRIPTION_MAX_INTERVAL = 12 * 3600
+# Сколько раз проверять канал за средний промежуток между его видео
+SUBSCRIPTION_CHECKS_PER_UPLOAD = 24
+# Сколько последних публикаций учитывать при оценке частоты загрузок
+SUBSCRIPTION_CADENCE_SAMPLES = 10
+# После нового видео канал проверяется вдвое чаще в течение этого времени, секунды
+SUBSCRIPTION_ACTIVE_WINDOW = 6 * 3600
+# Случайный разброс интервала (±доля), чтобы проверки каналов не совпадали по времени
+SUBSCRIPTION_INTERVAL_JITTER = 0.1
+# Общий бюджет проверок каналов в минуту
+SUBSCRIPTION_POLLS_PER_MINUTE = 30
+# Сколько каналов загружается одновременно
+SUBSCRIPTION_FETCH_CONCURRENCY = 4
+# Пауза между уведомлениями, чтобы не упираться в лимиты Telegram, секунды
+SUBSCRIPTION_NOTIFY_DELAY = 0.05
 subscriptions = {}
-subscription_tasks = {}
+
+# Состояние проверки каналов: ETag/Last-Modified ленты и ID уже известных видео
+CHANNEL_STATE_FILE = "channel_state.json"
+# Atom-лента канала; для проверки можно указать локальный сервер
+FEED_URL_TEMPLATE = "https://www.youtube.com/feeds/videos.xml?channel_id={channel_id}"
+FEED_TIMEOUT = 15
+FEED_MAX_CONNECTIONS = 10
+# Сколько последних ID видео канала помнить, чтобы не присылать уведомление повторно
+FEED_SEEN_IDS = 50
+channel_state = {}
+
+
+# Интервал, с которым измененные JSON-файлы состояния сохраняются на диск
+STATE_FLUSH_INTERVAL = 5
 
 
 SUPPORTED_BROWSERS = ['chrome', 'firefox', 'edge', 'opera', 'vivaldi', 'safari']
 
 SEARCH_QUERY, SEARCH_RESULT = range(2)
 
+SEND_FILE_TIMEOUT = 300
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.ogg', '.wav')
+
 MAX_SEARCH_LENGTH = 200
 MIN_SEARCH_INTERVAL = 5
 SEARCH_TIMEOUT = 30
+
+# Отдельные пулы потоков для разных видов работы:
+# (потоков, максимум ожидающих вызовов, таймаут вызова в секундах; 0 — без таймаута)
+EXECUTOR_LIMITS = {
+    'search': (2, 10, SEARCH_TIMEOUT),
+    'metadata': (METADATA_WORKERS, 20, METADATA_TIMEOUT),
+    # Загрузки запускают только обработчики очереди; прервать загрузку можно отменой задания
+    'download': (DOWNLOAD_WORKERS, DOWNLOAD_WORKERS, 0),
+    # Конвертация аудио и очистка кэша по квоте (cache_reaper)
+    'postprocess': (2, DOWNLOAD_WORKERS + 1, 600),
+}
 last_search_time = {}
 
 
@@ -158,48 +310,552 @@ def normalize_url(url):
         logger.error(f"Ошибка при нормализации URL {url}: {e}")
         return url
 
-# Загрузка данных пользователей из файла
+def snapshot_state(data):
+    """Копия словарей и списков JSON-данных; сами значения не копируются"""
+    if isinstance(data, dict):
+        return {key: snapshot_state(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [snapshot_state(value) for value in data]
+    return data
+
+class StatePersister:
+    """Отложенное атомарное сохранение JSON-файлов состояния в фоновом потоке.
+
+    Данные меняются в цикле событий, поэтому снимок для записи снимается там же —
+    не чаще раза за flush_interval, а фоновый поток только сериализует и пишет его."""
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.sources = {}  # путь -> функция, возвращающая данные для сохранения
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.loop = None
+
+    def register(self, path, get_data):
+        self.sources[path] = get_data
+
+    def mark_dirty(self, path):
+        """Помечает файл измененным; запись произойдет при следующем сбросе"""
+        with self.lock:
+            self.dirty.add(path)
+
+    def start(self, loop):
+        """Запускает фоновый поток; снимки данных снимаются в цикле событий loop"""
+        if self.thread is None:
+            self.loop = loop
+            self.thread = threading.Thread(target=self._run, name="state-persister", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и сохраняет все несохраненные изменения"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        # Цикл событий уже остановлен, данные больше никто не меняет
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                snapshots = self._take_snapshots_on_loop()
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке состояния к сохранению: {e}")
+                logger.error(traceback.format_exc())
+                continue
+            if snapshots:
+                self.write(snapshots)
+
+    def _take_snapshots_on_loop(self):
+        """Снимки из цикла событий; None, если цикл не ответил до остановки (изменения остаются помеченными)"""
+        future = Future()
+
+        def take():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self.take_snapshots())
+            except Exception as e:
+                future.set_exception(e)
+
+        try:
+            self.loop.call_soon_threadsafe(take)
+        except RuntimeError:
+            # Цикл событий уже закрыт
+            return None
+        while not self.stopped.is_set():
+            try:
+                return future.result(timeout=self.flush_interval)
+            except FutureTimeoutError:
+                pass
+        # Снимок, который уже начали снимать, дожидаемся; иначе его снимет stop()
+        return None if future.cancel() else future.result()
+
+    def take_snapshots(self):
+        """Копии измененных данных {путь: снимок}; вызывать в потоке, который меняет данные"""
+        with self.lock:
+            paths = self.dirty
+            self.dirty = set()
+        return {path: snapshot_state(self.sources[path]()) for path in paths}
+
+    def flush(self):
+        """Сохраняет изменения сразу; вызывать в потоке, который меняет данные"""
+        self.write(self.take_snapshots())
+
+    def write(self, snapshots):
+        for path, data in snapshots.items():
+            try:
+                self._write(path, json.dumps(data, ensure_ascii=False, indent=2))
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении {path}: {e}")
+                logger.error(traceback.format_exc())
+                self.mark_dirty(path)
+
+    @staticmethod
+    def _write(path, payload):
+        """Пишет во временный файл, делает fsync и атомарно заменяет им исходный"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+state_persister = StatePersister(STATE_FLUSH_INTERVAL)
+
+class UserStore:
+    """Реестр пользователей на SQLite (WAL) с атомарными счетчиками и агрегатными запросами"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, "
+                "username TEXT, "
+                "first_name TEXT, "
+                "last_name TEXT, "
+                "join_date TEXT, "
+                "last_seen REAL, "
+                "download_count INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_users_download_count ON users (download_count)")
+
+    def upsert(self, user_id, username, first_name, last_name):
+        """Добавляет пользователя или обновляет его данные и время активности"""
+        now = time.time()
+        with self.lock, self.conn:
+            # Существующая строка перезаписывается не чаще раза в LAST_SEEN_RESOLUTION секунд
+            self.conn.execute(
+                "INSERT INTO users (user_id, username, first_name, last_name, join_date, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "username = excluded.username, first_name = excluded.first_name, "
+                "last_name = excluded.last_name, last_seen = excluded.last_seen "
+                "WHERE users.last_seen IS NULL OR users.last_seen < ?",
+                (str(user_id), username, first_name, last_name, datetime.now().isoformat(), now,
+                 now - LAST_SEEN_RESOLUTION)
+            )
+
+    def increment_downloads(self, user_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE users SET download_count = download_count + 1 WHERE user_id = ?", (str(user_id),)
+            )
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def count_active(self, days):
+        """Количество пользователей, активных за последние days дней"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM users WHERE last_seen >= ?", (time.time() - days * 86400,)
+            ).fetchone()[0]
+
+    def top_downloaders(self, limit):
+        """Возвращает [(user_id, username, download_count)] с наибольшим числом загрузок"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT user_id, username, download_count FROM users "
+                "WHERE download_count > 0 ORDER BY download_count DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def iter_user_ids(self, batch_size=500):
+        """Перебирает ID пользователей порциями, не загружая всех в память"""
+        last_user_id = ''
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_user_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for (user_id,) in rows:
+                yield user_id
+            last_user_id = rows[-1][0]
+
+    def migrate_from_json(self, json_path):
+        """Однократно переносит пользователей из старого user_data.json в базу"""
+        if not os.path.exists(json_path):
+            return 0
+
+        with open(json_path, 'r', encoding='utf-8') as f:
+            user_data = json.load(f)
+
+        rows = []
+        for user_id, data in user_data.items():
+            try:
+                last_seen = datetime.fromisoformat(data['join_date']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                last_seen = None
+            rows.append((
+                str(user_id), data.get('username'), data.get('first_name'), data.get('last_name'),
+                data.get('join_date'), last_seen, data.get('download_count', 0)
+            ))
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users "
+                "(user_id, username, first_name, last_name, join_date, last_seen, download_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+        # Переименовываем старый файл, чтобы миграция не повторялась
+        os.replace(json_path, json_path + ".migrated")
+        return len(rows)
+
+# Открытие реестра пользователей
 def load_user_data():
-    global user_data
+    global user_store
     try:
-        if os.path.exists(USER_DATA_FILE):
-            with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-                logger.info(f"Загружены данные {len(user_data)} пользователей")
+        user_store = UserStore(USER_DB_FILE)
+        migrated = user_store.migrate_from_json(USER_DATA_FILE)
+        if migrated:
+            logger.info(f"Перенесено {migrated} пользователей из {USER_DATA_FILE} в {USER_DB_FILE}")
+        logger.info(f"Загружены данные {user_store.count()} пользователей")
     except Exception as e:
         logger.error(f"Ошибка при загрузке данных пользователей: {e}")
         logger.error(traceback.format_exc())
 
-# Сохранение данных пользователей в файл
-def save_user_data():
+def get_video_id(url):
+    """Извлекает ID видео из URL (YouTube, TikTok), если это возможно"""
     try:
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        parsed = urllib.parse.urlparse(normalize_url(url))
+        query_params = urllib.parse.parse_qs(parsed.query)
+        if 'v' in query_params:
+            return query_params['v'][0]
+
+        path_parts = [part for part in parsed.path.split('/') if part]
+        for marker in ('video', 'shorts'):
+            if marker in path_parts and path_parts.index(marker) + 1 < len(path_parts):
+                return path_parts[path_parts.index(marker) + 1]
     except Exception as e:
-        logger.error(f"Ошибка при сохранении данных пользователей: {e}")
-        logger.error(traceback.format_exc())
+        logger.error(f"Ошибка при извлечении ID видео из {url}: {e}")
+    return None
+
+class VideoCacheStore:
+    """Хранилище кэша видео на SQLite (WAL) с индексами по хэшу URL, нормализованному URL и ID видео"""
+
+    COLUMNS = (
+        'url_hash', 'url', 'normalized_url', 'video_id', 'file_path', 'format_id',
+        'quality', 'duration', 'title', 'url_type', 'cached_date', 'format_key',
+        'file_id', 'file_unique_id', 'media_type', 'file_size', 'last_access', 'hit_count'
+    )
+
+    # Колонки, добавленные после первой версии схемы
+    ADDED_COLUMNS = (
+        ('format_key', 'TEXT'),
+        ('file_id', 'TEXT'),
+        ('file_unique_id', 'TEXT'),
+        ('media_type', 'TEXT'),
+        ('file_size', 'INTEGER'),
+        ('last_access', 'REAL'),
+        ('hit_count', 'INTEGER DEFAULT 0'),
+    )
+
+    # Счетчики, которые описывают содержимое таблицы и пересчитываются при очистке
+    CONTENT_STATS = ('entries', 'files', 'total_bytes')
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.stats = {}
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS video_cache ("
+                "url_hash TEXT PRIMARY KEY, "
+                "url TEXT NOT NULL, "
+                "normalized_url TEXT NOT NULL, "
+                "video_id TEXT, "
+                "file_path TEXT, "
+                "format_id TEXT, "
+                "quality TEXT, "
+                "duration REAL, "
+                "title TEXT, "
+                "url_type TEXT, "
+                "cached_date REAL, "
+                "format_key TEXT, "
+                "file_id TEXT, "
+                "file_unique_id TEXT, "
+                "media_type TEXT, "
+                "file_size INTEGER, "
+                "last_access REAL, "
+                "hit_count INTEGER DEFAULT 0)"
+            )
+            # Базы, созданные старыми версиями бота, не содержат новых колонок
+            columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(video_cache)")]
+            for column, column_type in self.ADDED_COLUMNS:
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE video_cache ADD COLUMN {column} {column_type}")
+            self._backfill_format_keys()
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_video_cache_normalized_url ON video_cache (normalized_url)")
+
+            stats_exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_stats'"
+            ).fetchone()
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            if not stats_exists:
+                self._rebuild_stats()
+            self.stats = {row['name']: row['value'] for row in self.conn.execute("SELECT name, value FROM cache_stats")}
+
+    def _backfill_format_keys(self):
+        """Записям без format_key (из старых версий и video_cache.json) назначает ключ версии и хэш, по которым их ищет кэш"""
+        rows = self.conn.execute("SELECT url_hash, url, format_id FROM video_cache WHERE format_key IS NULL").fetchall()
+        for row in rows:
+            format_key = get_format_key('video' if row['format_id'] else 'best', row['format_id'])
+            cursor = self.conn.execute(
+                "UPDATE OR IGNORE video_cache SET url_hash = ?, format_key = ? WHERE url_hash = ?",
+                (get_cache_key(row['url'], format_key), format_key, row['url_hash'])
+            )
+            if not cursor.rowcount:
+                # Такая версия уже есть в кэше; старая запись остается под прежним хэшем до вытеснения
+                self.conn.execute(
+                    "UPDATE video_cache SET format_key = ? WHERE url_hash = ?", (format_key, row['url_hash'])
+                )
+        if rows:
+            logger.info(f"Записям кэша назначены ключи версий: {len(rows)}")
+
+    def _rebuild_stats(self):
+        """Пересчитывает счетчики содержимого по таблице (при миграции и первом запуске)"""
+        self.conn.execute(
+            "DELETE FROM cache_stats WHERE name IN ('entries', 'files', 'total_bytes') OR name LIKE 'bytes:%'"
+        )
+        deltas = {name: 0 for name in self.CONTENT_STATS}
+        for row in self.conn.execute("SELECT * FROM video_cache"):
+            for name, value in self._entry_stats(dict(row)).items():
+                deltas[name] = deltas.get(name, 0) + value
+        self.stats = {name: value for name, value in self.stats.items()
+                      if name not in self.CONTENT_STATS and not name.startswith('bytes:')}
+        self._add_stats(deltas)
+
+    @staticmethod
+    def _entry_stats(entry, sign=1):
+        """Вклад одной записи в счетчики"""
+        file_size = (entry.get('file_size') or 0) if entry.get('file_path') else 0
+        return {
+            'entries': sign,
+            'files': sign if entry.get('file_path') else 0,
+            'total_bytes': sign * file_size,
+            f"bytes:{entry.get('url_type') or 'unknown'}": sign * file_size,
+        }
+
+    def _add_stats(self, deltas):
+        """Применяет приращения счетчиков в текущей транзакции и в памяти"""
+        for name, delta in deltas.items():
+            if not delta and name in self.stats:
+                continue
+            self.conn.execute(
+                "INSERT INTO cache_stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, delta)
+            )
+            self.stats[name] = self.stats.get(name, 0) + delta
+
+    def _get_row(self, url_hash):
+        row = self.conn.execute("SELECT * FROM video_cache WHERE url_hash = ?", (url_hash,)).fetchone()
+        return dict(row) if row else None
+
+    def get(self, url_hash):
+        """Возвращает запись кэша по хэшу URL"""
+        with self.lock:
+            return self._get_row(url_hash)
+
+    def find_by_normalized_url(self, normalized_url):
+        """Возвращает все записи кэша для нормализованного URL"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM video_cache WHERE normalized_url = ?", (normalized_url,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _insert(self, entry):
+        values = tuple(entry.get(column) for column in self.COLUMNS)
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO video_cache ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+            values
+        )
+
+    def put(self, entry):
+        """Добавляет или заменяет одну запись кэша"""
+        with self.lock, self.conn:
+            old_entry = self._get_row(entry['url_hash'])
+            if old_entry:
+                self._add_stats(self._entry_stats(old_entry, -1))
+            self._insert(entry)
+            self._add_stats(self._entry_stats(entry))
+
+    def set_file_id(self, entry):
+        """Сохраняет file_id Telegram для версии; создает запись, если ее еще нет"""
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE video_cache SET file_id = ?, file_unique_id = ?, media_type = ? WHERE url_hash = ?",
+                (entry['file_id'], entry.get('file_unique_id'), entry.get('media_type'), entry['url_hash'])
+            )
+            if cursor.rowcount:
+                return
+            self._insert(entry)
+            self._add_stats(self._entry_stats(entry))
+
+    def clear_file_id(self, url_hash):
+        """Забывает устаревший file_id"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE video_cache SET file_id = NULL, file_unique_id = NULL WHERE url_hash = ?", (url_hash,)
+            )
+
+    def record_access(self, url_hash):
+        """Отмечает отправку версии: время доступа и счетчик обращений для вытеснения"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE video_cache SET last_access = ?, hit_count = COALESCE(hit_count, 0) + 1 WHERE url_hash = ?",
+                (time.time(), url_hash)
+            )
+
+    def record_lookup(self, found):
+        """Учитывает поиск ссылки пользователя в кэше как попадание или промах"""
+        with self.lock, self.conn:
+            self._add_stats({'hits' if found else 'misses': 1})
+
+    def local_entries(self):
+        """Возвращает записи, у которых есть локальный файл"""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM video_cache WHERE file_path IS NOT NULL").fetchall()
+        return [dict(row) for row in rows]
+
+    def set_file_size(self, url_hash, file_size):
+        with self.lock, self.conn:
+            old_entry = self._get_row(url_hash)
+            if not old_entry:
+                return
+            self._add_stats(self._entry_stats(old_entry, -1))
+            self.conn.execute("UPDATE video_cache SET file_size = ? WHERE url_hash = ?", (file_size, url_hash))
+            self._add_stats(self._entry_stats(dict(old_entry, file_size=file_size)))
+
+    def drop_local_file(self, url_hash):
+        """Убирает локальный файл из записи; запись без file_id удаляется целиком"""
+        with self.lock, self.conn:
+            old_entry = self._get_row(url_hash)
+            if not old_entry:
+                return
+            self._add_stats(self._entry_stats(old_entry, -1))
+            if not old_entry.get('file_id'):
+                self.conn.execute("DELETE FROM video_cache WHERE url_hash = ?", (url_hash,))
+                return
+            self.conn.execute(
+                "UPDATE video_cache SET file_path = NULL, file_size = NULL WHERE url_hash = ?", (url_hash,)
+            )
+            self._add_stats(self._entry_stats(dict(old_entry, file_path=None, file_size=None)))
+
+    def usage(self):
+        """Возвращает (байт на диске, файлов на диске)"""
+        with self.lock:
+            return self.stats.get('total_bytes', 0), self.stats.get('files', 0)
+
+    def get_stats(self):
+        """Возвращает копию всех счетчиков"""
+        with self.lock:
+            return dict(self.stats)
+
+    def all_entries(self):
+        """Возвращает все записи кэша"""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM video_cache").fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.stats.get('entries', 0)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM video_cache")
+            self._rebuild_stats()
+
+    def migrate_from_json(self, json_path):
+        """Однократно переносит записи из старого video_cache.json в базу"""
+        if not os.path.exists(json_path):
+            return 0
+
+        with open(json_path, 'r', encoding='utf-8') as f:
+            video_cache = json.load(f)
+
+        rows = []
+        for cache_data in video_cache.values():
+            entry = dict(cache_data)
+            # Старый хэш не учитывал формат; запись получает ключ версии, по которому ее ищет кэш
+            entry['format_key'] = entry.get('format_key') or get_format_key(
+                'video' if entry.get('format_id') else 'best', entry.get('format_id')
+            )
+            entry['url_hash'] = get_cache_key(entry['url'], entry['format_key'])
+            entry['normalized_url'] = entry.get('normalized_url') or normalize_url(entry['url'])
+            entry['video_id'] = get_video_id(entry['url'])
+            file_path = entry.get('file_path')
+            entry['file_size'] = os.path.getsize(file_path) if file_path and os.path.exists(file_path) else 0
+            rows.append(tuple(entry.get(column) for column in self.COLUMNS))
+
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO video_cache ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                rows
+            )
+            self._rebuild_stats()
 
-# Загрузка кэша видео из файла
+        # Переименовываем старый файл, чтобы миграция не повторялась
+        os.replace(json_path, json_path + ".migrated")
+        return len(rows)
+
+# Открытие хранилища кэша видео
 def load_video_cache():
-    video_cache = {}
+    global video_cache_store
     try:
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                video_cache = json.load(f)
-                logger.info(f"Загружено {len(video_cache)} видео в кэше")
+        video_cache_store = VideoCacheStore(CACHE_DB_FILE)
+        migrated = video_cache_store.migrate_from_json(CACHE_FILE)
+        if migrated:
+            logger.info(f"Перенесено {migrated} видео из {CACHE_FILE} в {CACHE_DB_FILE}")
+        logger.info(f"Загружено {video_cache_store.count()} видео в кэше")
     except Exception as e:
         logger.error(f"Ошибка при загрузке кэша видео: {e}")
         logger.error(traceback.format_exc())
-    return video_cache
-
-# Сохранение кэша видео в файл
-def save_video_cache(video_cache):
-    try:
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(video_cache, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении кэша видео: {e}")
-        logger.error(traceback.format_exc())
 
 # Генерация хэша для URL
 def get_url_hash(url):
@@ -207,54 +863,77 @@ def get_url_hash(url):
     normalized_url = normalize_url(url)
     return hashlib.md5(normalized_url.encode('utf-8')).hexdigest()
 
-# Проверка наличия видео в кэше
-def check_video_cache(url, video_cache):
-    url_hash = get_url_hash(url)
-    if url_hash in video_cache:
-        cache_entry = video_cache[url_hash]
-        # Проверяем, существует ли файл
-        if os.path.exists(cache_entry['file_path']):
-            return cache_entry
+def get_format_key(format_type, format_id=None):
+    """Возвращает ключ формата для версии в кэше (best, max, audio, video:<id>)"""
+    if format_type == 'video' and format_id:
+        return f"video:{format_id}"
+    if format_type == 'tiktok':
+        return 'best'
+    return format_type
+
+# Генерация ключа версии: одна запись кэша на пару (видео, формат)
+def get_cache_key(url, format_key):
+    normalized_url = normalize_url(url)
+    return hashlib.md5(f"{normalized_url}|{format_key}".encode('utf-8')).hexdigest()
+
+def is_cache_entry_available(cache_entry):
+    """Версию можно отправить, если известен file_id или существует локальный файл"""
+    if cache_entry.get('file_id'):
+        return True
+    return bool(cache_entry.get('file_path')) and os.path.exists(cache_entry['file_path'])
+
+def get_task_format_key(task):
+    """Ключ формата версии, которую скачивает запрос из очереди"""
+    return get_format_key("best" if task.url_type == "tiktok" else task.format_type, task.format_id)
+
+def get_task_cache_entry(task):
+    """Доступная версия из кэша для запроса из очереди или None"""
+    cache_entry = video_cache_store.get(get_cache_key(task.url, get_task_format_key(task)))
+    if cache_entry and is_cache_entry_available(cache_entry):
+        return cache_entry
     return None
 
 # Получение информации о кэшированных версиях видео
 def get_cached_versions(url):
-    video_cache = load_video_cache()
-    cached_versions = []
-
-    # Нормализуем URL для поиска
+    # Поиск идет по индексу normalized_url, поэтому проверяются только файлы найденных версий
     normalized_url = normalize_url(url)
-    logger.info(f"Поиск в кэше для URL: {url} (нормализованный: {normalized_url})")
-
-    for url_hash, cache_data in video_cache.items():
-        # Нормализуем URL из кэша для сравнения
-        cached_normalized_url = normalize_url(cache_data['url'])
-        logger.info(f"Кэш запись: {cache_data['url']} (нормализованный: {cached_normalized_url})")
-
-        if cached_normalized_url == normalized_url and os.path.exists(cache_data['file_path']):
-            cached_versions.append(cache_data)
-
-    logger.info(f"Найдено {len(cached_versions)} кэшированных версий для URL: {url}")
+    cached_versions = [
+        cache_data for cache_data in video_cache_store.find_by_normalized_url(normalized_url)
+        if is_cache_entry_available(cache_data)
+    ]
+    # Попадания и промахи считаются только здесь, по одному на ссылку пользователя
+    video_cache_store.record_lookup(bool(cached_versions))
+
+    logger.debug(f"Найдено {len(cached_versions)} кэшированных версий для URL: {url} (нормализованный: {normalized_url})")
     return cached_versions
 
 # Добавление видео в кэш
-def add_to_video_cache(url, file_path, format_id, quality, duration, title, url_type):
+def add_to_video_cache(url, file_path, format_id, quality, duration, title, url_type, format_key=None):
     try:
-        video_cache = load_video_cache()
-        url_hash = get_url_hash(url)
-
-        # Перемещаем файл в кэш-директорию
-        filename = os.path.basename(file_path)
-        cache_file_path = os.path.join(CACHE_DIR, filename)
-
-        # Если файл уже не в кэш-директории, перемещаем его
-        if os.path.dirname(file_path) != CACHE_DIR:
+        format_key = format_key or get_format_key('video' if format_id else 'best', format_id)
+        url_hash = get_cache_key(url, format_key)
+
+        # У каждой версии свой файл: имя по хэшу URL и формату, а не по названию видео
+        safe_format_key = re.sub(r'[^\w-]', '_', format_key)
+        extension = os.path.splitext(file_path)[1]
+        cache_file_path = os.path.join(CACHE_DIR, f"{url_hash}_{safe_format_key}{extension}")
+        if os.path.abspath(file_path) != os.path.abspath(cache_file_path):
             shutil.move(file_path, cache_file_path)
-        else:
-            cache_file_path = file_path
+
+        # Файл прежней записи этой версии (старые записи называли файл по названию видео)
+        old_entry = video_cache_store.get(url_hash)
+        old_path = old_entry and old_entry.get('file_path')
+        if old_path and os.path.abspath(old_path) != os.path.abspath(cache_file_path):
+            shared = any(
+                entry['url_hash'] != url_hash and entry.get('file_path') == old_path
+                for entry in video_cache_store.find_by_normalized_url(normalize_url(url))
+            )
+            if not shared and os.path.exists(old_path):
+                os.remove(old_path)
 
         # Добавляем запись в кэш
-        video_cache[url_hash] = {
+        video_cache_store.put({
+            'url_hash': url_hash,
             'url': url,  # Сохраняем оригинальный URL
             'file_path': cache_file_path,
             'format_id': format_id,
@@ -263,10 +942,14 @@ def add_to_video_cache(url, file_path, format_id, quality, duration, title, url_
             'title': title,
             'url_type': url_type,
             'cached_date': time.time(),
-            'normalized_url': normalize_url(url)  # Добавляем нормализованный URL для поиска
-        }
+            'normalized_url': normalize_url(url),  # Нормализованный URL для поиска
+            'video_id': get_video_id(url),
+            'format_key': format_key,
+            'file_size': os.path.getsize(cache_file_path),
+            'last_access': time.time(),
+            'hit_count': 0
+        })
 
-        save_video_cache(video_cache)
         logger.info(f"Видео добавлено в кэш: {url} (нормализованный: {normalize_url(url)})")
         return cache_file_path
     except Exception as e:
@@ -274,6 +957,170 @@ def add_to_video_cache(url, file_path, format_id, quality, duration, title, url_
         logger.error(traceback.format_exc())
         return file_path
 
+def get_sent_file_ids(sent_message):
+    """Возвращает (file_id, file_unique_id, media_type) из отправленного сообщения"""
+    for media_type in ('video', 'audio', 'document', 'animation'):
+        media = getattr(sent_message, media_type, None)
+        if media:
+            return media.file_id, media.file_unique_id, media_type
+    return None, None, None
+
+def register_sent_file(url, format_key, sent_message, title, url_type, duration=0, quality=None, format_id=None, url_hash=None):
+    """Запоминает file_id отправленного файла, чтобы следующие запросы не загружали его заново"""
+    try:
+        file_id, file_unique_id, media_type = get_sent_file_ids(sent_message)
+        if not file_id:
+            return
+
+        video_cache_store.set_file_id({
+            'url_hash': url_hash or get_cache_key(url, format_key),
+            'url': url,
+            'normalized_url': normalize_url(url),
+            'video_id': get_video_id(url),
+            'file_path': None,
+            'format_id': format_id,
+            'quality': quality,
+            'duration': duration,
+            'title': title,
+            'url_type': url_type,
+            'cached_date': time.time(),
+            'format_key': format_key,
+            'file_id': file_id,
+            'file_unique_id': file_unique_id,
+            'media_type': media_type
+        })
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении file_id: {e}")
+        logger.error(traceback.format_exc())
+
+async def send_media(bot, chat_id, media, media_type, caption, title, source_text):
+    """Отправляет файл или file_id нужным методом Telegram"""
+    if media_type == 'audio':
+        request = bot.send_audio(
+            chat_id=chat_id,
+            audio=media,
+            caption=caption,
+            title=title[:30] + "..." if len(title) > 30 else title,
+            performer=source_text
+        )
+    elif media_type == 'document':
+        request = bot.send_document(chat_id=chat_id, document=media, caption=caption)
+    elif media_type == 'animation':
+        request = bot.send_animation(chat_id=chat_id, animation=media, caption=caption)
+    else:
+        request = bot.send_video(
+            chat_id=chat_id,
+            video=media,
+            caption=caption,
+            supports_streaming=True
+        )
+    return await asyncio.wait_for(request, timeout=SEND_FILE_TIMEOUT)
+
+async def send_cached_media(bot, chat_id, cache_data, caption, source_text):
+    """Отправляет версию из кэша: по file_id, а если Telegram его отклонил — из локального файла"""
+    title = cache_data.get('title') or 'Video'
+    file_path = cache_data.get('file_path')
+
+    video_cache_store.record_access(cache_data['url_hash'])
+
+    file_id = cache_data.get('file_id')
+    if file_id:
+        try:
+            return await send_media(bot, chat_id, file_id, cache_data.get('media_type'), caption, title, source_text)
+        except BadRequest as e:
+            logger.warning(f"Telegram отклонил file_id для {cache_data['url']}: {e}")
+            video_cache_store.clear_file_id(cache_data['url_hash'])
+
+    if not file_path or not os.path.exists(file_path):
+        return None
+
+    media_type = 'audio' if file_path.endswith(AUDIO_EXTENSIONS) else 'video'
+    with open(file_path, 'rb') as file:
+        sent_message = await send_media(bot, chat_id, file, media_type, caption, title, source_text)
+
+    register_sent_file(
+        cache_data['url'], cache_data.get('format_key'), sent_message, title, cache_data.get('url_type'),
+        cache_data.get('duration'), cache_data.get('quality'), cache_data.get('format_id'), cache_data['url_hash']
+    )
+    return sent_message
+
+# Политики вытеснения: ключ сортировки, первыми удаляются записи с наименьшим ключом
+def lru_eviction_key(entry):
+    return entry.get('last_access') or entry.get('cached_date') or 0
+
+def lfu_eviction_key(entry):
+    return (entry.get('hit_count') or 0, lru_eviction_key(entry))
+
+def size_weighted_eviction_key(entry):
+    # Большие и редко запрашиваемые файлы вытесняются первыми
+    return -(entry.get('file_size') or 0) / ((entry.get('hit_count') or 0) + 1)
+
+EVICTION_POLICIES = {
+    'lru': lru_eviction_key,
+    'lfu': lfu_eviction_key,
+    'size': size_weighted_eviction_key,
+}
+
+def reap_video_cache():
+    """Удаляет локальные файлы кэша, пока не будет соблюдена квота. Возвращает (файлов, байт)"""
+    total_bytes, total_entries = video_cache_store.usage()
+    if not ((CACHE_MAX_BYTES and total_bytes > CACHE_MAX_BYTES) or
+            (CACHE_MAX_ENTRIES and total_entries > CACHE_MAX_ENTRIES)):
+        return 0, 0
+
+    entries = video_cache_store.local_entries()
+
+    # Записи, созданные до учета размеров, дополняем размером файла
+    for entry in entries:
+        if entry.get('file_size') is None:
+            file_path = entry['file_path']
+            entry['file_size'] = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            video_cache_store.set_file_size(entry['url_hash'], entry['file_size'])
+
+    total_bytes = sum(entry['file_size'] for entry in entries)
+    total_entries = len(entries)
+
+    def over_quota():
+        return ((CACHE_MAX_BYTES and total_bytes > CACHE_MAX_BYTES) or
+                (CACHE_MAX_ENTRIES and total_entries > CACHE_MAX_ENTRIES))
+
+    if not over_quota():
+        return 0, 0
+
+    eviction_key = EVICTION_POLICIES.get(CACHE_EVICTION_POLICY, lru_eviction_key)
+    evicted_files = 0
+    evicted_bytes = 0
+    for entry in sorted(entries, key=eviction_key):
+        if not over_quota():
+            break
+        try:
+            if os.path.exists(entry['file_path']):
+                os.remove(entry['file_path'])
+        except OSError as e:
+            logger.error(f"Ошибка при удалении файла кэша {entry['file_path']}: {e}")
+            continue
+        video_cache_store.drop_local_file(entry['url_hash'])
+        total_bytes -= entry['file_size']
+        total_entries -= 1
+        evicted_files += 1
+        evicted_bytes += entry['file_size']
+
+    logger.info(f"Из кэша вытеснено {evicted_files} файлов ({evicted_bytes//1024//1024} МБ), политика {CACHE_EVICTION_POLICY}")
+    return evicted_files, evicted_bytes
+
+async def cache_reaper():
+    """Фоновая задача, поддерживающая размер кэша в пределах квоты"""
+    while True:
+        try:
+            # Удаление файлов и запросы к SQLite — та же дисковая работа, что и постобработка
+            await executors['postprocess'].run(reap_video_cache)
+        except ExecutorBusyError as e:
+            logger.warning(f"Очистка кэша отложена до следующего запуска: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке кэша по квоте: {e}")
+            logger.error(traceback.format_exc())
+        await asyncio.sleep(CACHE_REAPER_INTERVAL)
+
 def get_url_type(url):
     """Определяет тип URL (youtube, youtube_music, tiktok, unknown)"""
     try:
@@ -303,33 +1150,459 @@ def get_url_type(url):
         logger.error(f"Ошибка при определении типа URL {url}: {e}")
         return 'unknown'
 
+class VideoInfoCache:
+    """Кэш метаданных видео с TTL, LRU-ограничением, single-flight и кэшем недавних ошибок"""
+
+    class _Flight:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, ttl, max_entries, max_bytes, negative_ttl):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ключ -> (истекает, info, размер)
+        self.total_bytes = 0
+        self.failures = OrderedDict()  # ключ -> (истекает, исключение)
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+
+    def _lookup(self, key, now):
+        entry = self.entries.get(key)
+        if entry:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                return entry[1]
+            self._remove(key)
+        return None
+
+    def _remove(self, key):
+        self.total_bytes -= self.entries.pop(key)[2]
+
+    @staticmethod
+    def estimate_size(info):
+        """Приблизительный размер info в байтах: длина JSON"""
+        try:
+            return len(json.dumps(info, default=str))
+        except (TypeError, ValueError):
+            return 0
+
+    def get_or_extract(self, key, extract):
+        """Возвращает info из кэша или вызывает extract() — один раз на ключ, сколько бы ни было запросов"""
+        now = time.time()
+        with self.lock:
+            info = self._lookup(key, now)
+            if info is not None:
+                self.hits += 1
+                return info
+
+            failure = self.failures.get(key)
+            if failure:
+                if failure[0] > now:
+                    self.negative_hits += 1
+                    raise failure[1]
+                del self.failures[key]
+
+            flight = self.in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._Flight()
+                self.in_flight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = extract()
+        except Exception as e:
+            flight.error = e
+            with self.lock:
+                self.failures[key] = (time.time() + self.negative_ttl, e)
+                while len(self.failures) > self.max_entries:
+                    self.failures.popitem(last=False)
+            raise
+        else:
+            # Размер считается в потоке извлечения, а не под блокировкой
+            size = self.estimate_size(flight.result)
+            with self.lock:
+                if key in self.entries:
+                    self._remove(key)
+                self.entries[key] = (time.time() + self.ttl, flight.result, size)
+                self.total_bytes += size
+                while len(self.entries) > 1 and (
+                        len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                    self._remove(next(iter(self.entries)))
+            return flight.result
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.event.set()
+
+    def peek(self, key):
+        """Возвращает info из кэша без извлечения"""
+        with self.lock:
+            info = self._lookup(key, time.time())
+            if info is not None:
+                self.hits += 1
+            return info
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_hits': self.negative_hits,
+                'coalesced': self.coalesced,
+            }
+
+video_info_cache = VideoInfoCache(
+    METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES, METADATA_NEGATIVE_TTL
+)
+
+def get_info_cache_key(url):
+    """Ключ кэша метаданных: ID видео, а если его не извлечь — нормализованный URL"""
+    return get_video_id(url) or normalize_url(url)
+
+def get_cached_video_info(url):
+    """Возвращает ранее извлеченную информацию о видео, если она еще в кэше"""
+    return video_info_cache.peek(get_info_cache_key(url))
+
+def is_info_fresh(info):
+    """Проверяет, что ссылки форматов в info не истекут в ближайшие INFO_EXPIRY_MARGIN секунд"""
+    deadline = time.time() + INFO_EXPIRY_MARGIN
+    for fmt in info.get('formats') or []:
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(fmt.get('url') or '').query)
+        for param in ('expire', 'x-expires'):
+            if param in query_params:
+                try:
+                    if int(query_params[param][0]) < deadline:
+                        return False
+                except ValueError:
+                    pass
+    return True
+
+def download_with_info(ydl, url, info=None):
+    """Скачивает по уже извлеченному info; повторно извлекает, только если ссылки форматов устарели"""
+    if info and is_info_fresh(info):
+        try:
+            # process_ie_result изменяет словарь, поэтому работаем с копией
+            return ydl.process_ie_result(copy.deepcopy(info), download=True)
+        except yt_dlp.utils.DownloadError as e:
+            if not any(marker in str(e) for marker in STALE_FORMAT_ERRORS):
+                raise
+            logger.warning(f"Ссылки форматов устарели, повторно извлекаем информацию: {e}")
+    return ydl.extract_info(url, download=True)
+
+def trim_video_info(info):
+    """Копия info без полей METADATA_DROP_FIELDS (субтитры, превью, описание) для хранения в кэше"""
+    return {key: value for key, value in info.items() if key not in METADATA_DROP_FIELDS}
+
 def get_video_info(url, url_type):
-    """Получает информацию о видео с помощью yt-dlp"""
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': False,
-        # Добавляем параметры для работы с SSL
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
+    """Получает информацию о видео с помощью yt-dlp (через кэш метаданных)"""
+    return video_info_cache.get_or_extract(
+        get_info_cache_key(url), lambda: trim_video_info(extract_video_info(url, url_type))
+    )
 
-    # Добавляем cookies для YouTube, если доступны
-    if url_type in ['youtube', 'youtube_music']:
-        for cookies_file in COOKIES_FILES:
-            if os.path.exists(cookies_file):
-                ydl_opts['cookiefile'] = cookies_file
+class ExecutorBusyError(Exception):
+    """Пул потоков перегружен: очередь ожидающих вызовов заполнена"""
+
+class BoundedExecutor:
+    """Пул потоков с ограниченной очередью и таймаутом вызова, чтобы виды работы не мешали друг другу"""
+
+    def __init__(self, name, workers, max_pending, timeout):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        # Вызовы, отправленные в пул и еще не завершенные потоком; меняется только в цикле событий
+        self.active = 0
+        self.peak = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _on_done(self, future):
+        self.active -= 1
+        self.completed += 1
+
+    async def run(self, func, *args, timeout=None):
+        """Выполняет блокирующую функцию в пуле; ExecutorBusyError, если очередь полна"""
+        if self.active >= self.workers + self.max_pending:
+            self.rejected += 1
+            raise ExecutorBusyError(f"Пул {self.name} перегружен: {self.active} вызовов")
+        timeout = self.timeout if timeout is None else timeout
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        # Счетчик уменьшается, когда поток действительно освободится, даже после таймаута
+        future.add_done_callback(self._on_done)
+        if not timeout:
+            return await future
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # Поток прервать нельзя, он доработает в фоне и займет место в пуле
+            self.timeouts += 1
+            logger.error(f"{func.__name__} в пуле {self.name} не завершился за {timeout} сек")
+            raise
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def get_stats(self):
+        return {
+            'workers': self.workers,
+            'running': min(self.active, self.workers),
+            'pending': max(self.active - self.workers, 0),
+            'max_pending': self.max_pending,
+            'saturation': self.active * 100 / (self.workers + self.max_pending),
+            'peak': self.peak,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+executors = {name: BoundedExecutor(name, *limits) for name, limits in EXECUTOR_LIMITS.items()}
+
+class TokenBucket:
+    """Корзина токенов одной платформы; после HTTP 429 скорость временно снижается"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Во сколько раз снижена скорость после 429; восстанавливается с полупериодом RATE_LIMIT_RECOVERY
+        self.penalty = 1.0
+        self.penalized_at = 0
+
+    def current_penalty(self, now):
+        decay = 0.5 ** ((now - self.penalized_at) / RATE_LIMIT_RECOVERY)
+        return 1 + (self.penalty - 1) * decay
+
+    def reserve(self, now):
+        """Забирает токен и возвращает, сколько секунд нужно подождать (токены можно брать в долг)"""
+        rate = self.rate / self.current_penalty(now)
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / rate if self.tokens < 0 else 0
+
+    def penalize(self, now):
+        self.penalty = min(self.current_penalty(now) * RATE_LIMIT_BACKOFF, RATE_LIMIT_MAX_PENALTY)
+        self.penalized_at = now
+        # Накопленный запас сгорает, следующие запросы ждут уже по сниженной скорости
+        self.tokens = min(self.tokens, 0)
+
+class RateLimiter:
+    """Ограничитель частоты запросов к платформам: ждут только запросы сверх бюджета"""
+
+    def __init__(self, limits, default_limit):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.rate_limited = 0
+
+    def _bucket(self, platform):
+        bucket = self.buckets.get(platform)
+        if bucket is None:
+            rate, burst = self.limits.get(platform, self.default_limit)
+            bucket = self.buckets[platform] = TokenBucket(rate, burst)
+        return bucket
+
+    def reserve(self, platform):
+        """Резервирует запрос и возвращает задержку перед ним с учетом случайной добавки"""
+        with self.lock:
+            delay = self._bucket(platform).reserve(time.monotonic())
+            if delay > 0:
+                self.throttled += 1
+        return delay + random.uniform(0, RATE_LIMIT_JITTER) if delay > 0 else 0
+
+    async def acquire(self, platform):
+        delay = self.reserve(platform)
+        if delay:
+            logger.debug(f"Ограничение частоты {platform}: ожидание {delay:.1f} сек")
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self, platform):
+        """Блокирующий вариант для синхронного кода вне цикла событий"""
+        delay = self.reserve(platform)
+        if delay:
+            time.sleep(delay)
+
+    def report_error(self, platform, error):
+        """Снижает скорость платформы, если ошибка — ответ HTTP 429"""
+        if not any(marker in str(error) for marker in RATE_LIMIT_ERRORS):
+            return False
+        with self.lock:
+            bucket = self._bucket(platform)
+            bucket.penalize(time.monotonic())
+            self.rate_limited += 1
+            penalty = bucket.penalty
+        logger.warning(f"{platform} ответил HTTP 429, скорость запросов снижена в {penalty:.1f} раз")
+        return True
+
+rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+
+def find_cookies_file():
+    """Возвращает первый существующий файл cookies из COOKIES_FILES"""
+    for cookies_file in COOKIES_FILES:
+        if os.path.exists(cookies_file):
+            return cookies_file
+    return None
+
+class YoutubeDLPool:
+    """Готовые экземпляры YoutubeDL по профилям настроек; каждый поток использует только свои.
+
+    Экземпляр сохраняет cookies и открытые HTTP-соединения между вызовами и пересоздается
+    после max_uses вызовов или после любой ошибки."""
+
+    def __init__(self, profiles, max_uses):
+        self.profiles = profiles
+        self.max_uses = max_uses
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Все экземпляры пула (ydl -> запись), чтобы закрыть их при остановке бота
+        self.open = {}
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+
+    def _create(self, profile, cookies, entry):
+        opts = copy.deepcopy(self.profiles[profile])
+
+        def progress_hook(d):
+            # Хук текущего задания экземпляра; между заданиями его нет
+            if entry['progress_hook']:
+                entry['progress_hook'](d)
+
+        opts['progress_hooks'] = opts.get('progress_hooks', []) + [progress_hook]
+        if cookies:
+            cookies_file = find_cookies_file()
+            if cookies_file:
+                opts['cookiefile'] = cookies_file
                 logger.info(f"Используем cookies файл: {cookies_file}")
-                break
+        with self.lock:
+            self.created += 1
+        return yt_dlp.YoutubeDL(opts)
 
+    def _close(self, ydl):
+        try:
+            ydl.close()
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии YoutubeDL: {e}")
+
+    @contextmanager
+    def acquire(self, profile, cookies=False, progress_hook=None, **params):
+        """Выдает экземпляр профиля для текущего потока с настройками одного задания (paths, format и т.п.)"""
+        instances = getattr(self.local, 'instances', None)
+        if instances is None:
+            instances = self.local.instances = {}
+        key = (profile, cookies)
+        entry = instances.get(key)
+        # Вложенный вызов того же профиля в этом потоке получает временный экземпляр
+        pooled = entry is None or not entry['busy']
+        if entry is None or entry['busy']:
+            entry = {'uses': 0, 'busy': False, 'progress_hook': None, 'last_used': 0}
+            entry['ydl'] = self._create(profile, cookies, entry)
+            if pooled:
+                instances[key] = entry
+                with self.lock:
+                    self.open[entry['ydl']] = entry
+        else:
+            with self.lock:
+                self.reused += 1
+        ydl = entry['ydl']
+        defaults = self.profiles[profile]
+
+        entry['busy'] = True
+        ydl.params.update(params)
+        if 'format' in params:
+            ydl.format_selector = ydl.build_format_selector(params['format']) if params['format'] else None
+        entry['progress_hook'] = progress_hook
+        failed = True
+        try:
+            yield ydl
+            failed = False
+        finally:
+            entry['busy'] = False
+            entry['uses'] += 1
+            entry['last_used'] = time.monotonic()
+            # Возвращаем настройки профиля, чтобы следующее задание не унаследовало чужие
+            entry['progress_hook'] = None
+            for name in params:
+                if name in defaults:
+                    ydl.params[name] = copy.deepcopy(defaults[name])
+                else:
+                    ydl.params.pop(name, None)
+            if 'format' in params:
+                default_format = defaults.get('format')
+                ydl.format_selector = ydl.build_format_selector(default_format) if default_format else None
+
+            if not pooled or failed or entry['uses'] >= self.max_uses:
+                if pooled:
+                    del instances[key]
+                    with self.lock:
+                        self.open.pop(ydl, None)
+                        self.recycled += 1
+                self._close(ydl)
+
+    def close_all(self):
+        """Закрывает все экземпляры при остановке бота.
+
+        Каждый файл cookies сохраняется один раз — из последнего использованного экземпляра."""
+        with self.lock:
+            instances, self.open = self.open, {}
+        saved = set()
+        for ydl, entry in sorted(instances.items(), key=lambda item: item[1]['last_used'], reverse=True):
+            cookiefile = ydl.params.get('cookiefile')
+            if cookiefile in saved:
+                # Остальные экземпляры перезаписали бы файл своими, более старыми cookies
+                ydl.params.pop('cookiefile')
+            elif cookiefile:
+                saved.add(cookiefile)
+            self._close(ydl)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'recycled': self.recycled,
+                'open': len(self.open),
+            }
+
+ydl_pool = YoutubeDLPool(YDL_PROFILES, YDL_MAX_USES)
+
+def extract_video_info(url, url_type):
+    """Извлекает информацию о видео с помощью yt-dlp без кэша"""
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.acquire('info', cookies=url_type in COOKIES_URL_TYPES) as ydl:
             info = ydl.extract_info(url, download=False)
             return info
     except Exception as e:
         logger.error(f"Ошибка при получении информации о видео: {e}")
         logger.error(traceback.format_exc())
+        rate_limiter.report_error(url_type, e)
         raise e
 
 # Создание клавиатуры с выбором качества
@@ -398,17 +1671,16 @@ def create_cache_choice_keyboard(url, user_id, cached_versions, is_inline=False)
 
     # Добавляем кнопки для каждой кэшированной версии
     for i, cache_data in enumerate(cached_versions):
-        quality = cache_data.get('quality', 'Unknown')
-        # Безопасная проверка format_id
-        format_id = cache_data.get('format_id', '')
-        if format_id and isinstance(format_id, str) and format_id.startswith('video'):
-            format_type = 'video'
-        else:
+        quality = cache_data.get('quality') or 'Unknown'
+        file_path = cache_data.get('file_path') or ''
+        if cache_data.get('format_key') == 'audio' or file_path.endswith(AUDIO_EXTENSIONS):
             format_type = 'audio'
+        else:
+            format_type = 'video'
         size_text = ""
 
         # Получаем размер файла
-        if os.path.exists(cache_data['file_path']):
+        if os.path.exists(file_path):
             file_size = os.path.getsize(cache_data['file_path'])
             size_text = f" ({file_size//1024//1024}MB)"
 
@@ -433,50 +1705,29 @@ def create_cache_choice_keyboard(url, user_id, cached_versions, is_inline=False)
 
     return InlineKeyboardMarkup(keyboard)
 
-def download_video_sync(url, format_type, format_id=None, url_type='youtube', progress_hook=None):
-    """Синхронная функция скачивания видео с поддержкой прогресса"""
-    # Добавляем случайную задержку для избежания блокировок
-    time.sleep(random.uniform(1, 3))
-
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'outtmpl': '%(title)s.%(ext)s',
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
-
-    # Добавляем хук прогресса, если передан
-    if progress_hook:
-        ydl_opts['progress_hooks'] = [progress_hook]
-
-    # Добавляем cookies для YouTube, если доступны
-    if url_type in ['youtube', 'youtube_music']:
-        for cookies_file in COOKIES_FILES:
-            if os.path.exists(cookies_file):
-                ydl_opts['cookiefile'] = cookies_file
-                break
+def acquire_download_ydl(format_type, format_id, url_type, progress_hook=None, work_dir='.'):
+    """Экземпляр YoutubeDL из пула с форматом и папкой загрузки задания"""
+    cookies = url_type in COOKIES_URL_TYPES
+    if format_type == 'audio':
+        return ydl_pool.acquire('audio', cookies, progress_hook, paths={'home': work_dir})
 
     # Настраиваем формат для скачивания
     if format_type == 'best':
-        ydl_opts['format'] = 'best[height<=1080]'
+        ydl_format = 'best[height<=1080]'  # Лучшее качество до 1080p
     elif format_type == 'max':
-        ydl_opts['format'] = 'best'
-    elif format_type == 'audio':
-        ydl_opts['format'] = 'bestaudio/best'
-        ydl_opts['postprocessors'] = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }]
-    elif format_id:
-        ydl_opts['format'] = format_id
+        ydl_format = 'best'  # Абсолютно лучшее качество без ограничений
+    else:
+        ydl_format = format_id
+    return ydl_pool.acquire('video', cookies, progress_hook, paths={'home': work_dir}, format=ydl_format)
+
+def download_video_sync(url, format_type, format_id=None, url_type='youtube', progress_hook=None, info=None, work_dir='.'):
+    """Синхронная функция скачивания видео с поддержкой прогресса.
 
+    Частоту запросов ограничивает вызывающий код через rate_limiter.
+    Возвращает (путь к файлу, информация о видео, по которой шла загрузка)."""
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'video')
+        with acquire_download_ydl(format_type, format_id, url_type, progress_hook, work_dir) as ydl:
+            info = download_with_info(ydl, url, info)
             filename = ydl.prepare_filename(info)
 
             # Для аудио меняем расширение на mp3
@@ -484,9 +1735,10 @@ def download_video_sync(url, format_type, format_id=None, url_type='youtube', pr
                 base_name = os.path.splitext(filename)[0]
                 filename = base_name + '.mp3'
 
-            return filename, title
+            return filename, info
     except Exception as e:
         logger.error(f"Ошибка при скачивании видео: {e}")
+        rate_limiter.report_error(url_type, e)
         # Удаляем частично скачанный файл
         if 'filename' in locals():
             try:
@@ -496,50 +1748,32 @@ def download_video_sync(url, format_type, format_id=None, url_type='youtube', pr
                 pass
         raise e
 
-def download_audio_sync(url, url_type, progress_hook=None):
-    """Синхронная функция скачивания аудио с поддержкой прогресса"""
-    # Добавляем случайную задержку для избежания блокировок
-    time.sleep(random.uniform(1, 3))
-
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'format': 'bestaudio/best',
-        'outtmpl': '%(title)s.%(ext)s',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
-
-    # Добавляем хук прогресса, если передан
-    if progress_hook:
-        ydl_opts['progress_hooks'] = [progress_hook]
+def download_audio_sync(url, url_type, progress_hook=None, info=None, work_dir='.', extract_audio=True):
+    """Синхронная функция скачивания аудио с поддержкой прогресса.
 
-    # Добавляем cookies для YouTube, если доступны
-    if url_type in ['youtube', 'youtube_music']:
-        for cookies_file in COOKIES_FILES:
-            if os.path.exists(cookies_file):
-                ydl_opts['cookiefile'] = cookies_file
-                break
+    Частоту запросов ограничивает вызывающий код через rate_limiter. С extract_audio=False
+    возвращается исходный файл без конвертации в mp3 (см. extract_audio_sync).
+    Возвращает (путь к файлу, информация о видео, по которой шла загрузка)."""
+    if extract_audio:
+        format_type, format_id = 'audio', None
+    else:
+        # Профиль видео без постобработки, только с аудиоформатом
+        format_type, format_id = None, 'bestaudio/best'
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'audio')
+        with acquire_download_ydl(format_type, format_id, url_type, progress_hook, work_dir) as ydl:
+            info = download_with_info(ydl, url, info)
             filename = ydl.prepare_filename(info)
 
             # Меняем расширение на mp3
-            base_name = os.path.splitext(filename)[0]
-            filename = base_name + '.mp3'
+            if extract_audio:
+                base_name = os.path.splitext(filename)[0]
+                filename = base_name + '.mp3'
 
-            return filename, title
+            return filename, info
     except Exception as e:
         logger.error(f"Ошибка при скачивании аудио: {e}")
+        rate_limiter.report_error(url_type, e)
         # Удаляем частично скачанный файл
         if 'filename' in locals():
             try:
@@ -549,6 +1783,20 @@ def download_audio_sync(url, url_type, progress_hook=None):
                 pass
         raise e
 
+def extract_audio_sync(filename):
+    """Конвертирует скачанный файл в mp3 192 кбит/с и удаляет исходник"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+        postprocessor = yt_dlp.postprocessor.FFmpegExtractAudioPP(
+            ydl, preferredcodec=MP3_POSTPROCESSOR['preferredcodec'], preferredquality=MP3_POSTPROCESSOR['preferredquality'])
+        files_to_delete, info = postprocessor.run({
+            'filepath': filename,
+            'ext': os.path.splitext(filename)[1].lstrip('.'),
+        })
+    for path in files_to_delete:
+        if path != info['filepath'] and os.path.exists(path):
+            os.remove(path)
+    return info['filepath']
+
 def load_subscriptions():
     """Загружает подписки из файла"""
     global subscriptions
@@ -562,24 +1810,33 @@ def load_subscriptions():
         subscriptions = {}
 
 def save_subscriptions():
-    """Сохраняет подписки в файл"""
+    """Помечает подписки для сохранения в файл (в фоне, с объединением изменений)"""
+    state_persister.mark_dirty(SUBSCRIPTIONS_FILE)
+
+state_persister.register(SUBSCRIPTIONS_FILE, lambda: subscriptions)
+
+def load_channel_state():
+    """Загружает состояние проверки каналов из файла"""
+    global channel_state
     try:
-        with open(SUBSCRIPTIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(subscriptions, f, ensure_ascii=False, indent=2)
+        if os.path.exists(CHANNEL_STATE_FILE):
+            with open(CHANNEL_STATE_FILE, 'r', encoding='utf-8') as f:
+                channel_state = json.load(f)
+            logger.info(f"Загружено состояние {len(channel_state)} каналов")
     except Exception as e:
-        logger.error(f"Ошибка при сохранении подписок: {e}")
+        logger.error(f"Ошибка при загрузке состояния каналов: {e}")
+        channel_state = {}
+
+def save_channel_state():
+    """Помечает состояние каналов для сохранения в файл"""
+    state_persister.mark_dirty(CHANNEL_STATE_FILE)
+
+state_persister.register(CHANNEL_STATE_FILE, lambda: channel_state)
 
 def get_channel_info(url):
     """Получает информацию о канале"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'skip_download': True,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.acquire('channel') as ydl:
             info = ydl.extract_info(url, download=False)
 
             # Получаем ID канала
@@ -601,15 +1858,7 @@ def get_channel_info(url):
 def get_latest_videos(channel_url, max_results=5):
     """Получает последние видео с канала"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'skip_download': True,
-            'playlistend': max_results,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.acquire('channel', playlistend=max_results) as ydl:
             info = ydl.extract_info(channel_url, download=False)
 
             videos = []
@@ -622,7 +1871,8 @@ def get_latest_videos(channel_url, max_results=5):
                             'url': entry.get('url'),
                             'upload_date': entry.get('upload_date'),
                             'duration': entry.get('duration'),
-                            'view_count': entry.get('view_count')
+                            'view_count': entry.get('view_count'),
+                            'timestamp': entry.get('timestamp')
                         })
 
             return videos
@@ -630,6 +1880,157 @@ def get_latest_videos(channel_url, max_results=5):
         logger.error(f"Ошибка при получении видео с канала: {e}")
         return []
 
+class MetadataService:
+    """Асинхронное получение метаданных через yt-dlp в отдельном пуле потоков с таймаутом на вызов"""
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def run(self, func, *args):
+        """Выполняет блокирующую функцию в пуле метаданных, не занимая цикл событий"""
+        return await self.executor.run(func, *args)
+
+    async def video_info(self, url, url_type):
+        """Информация о видео; при попадании в кэш метаданных пул и лимит запросов не используются"""
+        info = get_cached_video_info(url)
+        if info is not None:
+            return info
+        await rate_limiter.acquire(url_type)
+        return await self.run(get_video_info, url, url_type)
+
+    async def channel_info(self, url):
+        """Информация о канале или None, как у get_channel_info"""
+        await rate_limiter.acquire('youtube')
+        try:
+            return await self.run(get_channel_info, url)
+        except (asyncio.TimeoutError, ExecutorBusyError):
+            return None
+
+    async def latest_videos(self, channel_url, max_results=5):
+        """Последние видео канала или пустой список, как у get_latest_videos"""
+        await rate_limiter.acquire('youtube')
+        try:
+            return await self.run(get_latest_videos, channel_url, max_results)
+        except (asyncio.TimeoutError, ExecutorBusyError):
+            return []
+
+metadata_service = MetadataService(executors['metadata'])
+
+FEED_NAMESPACES = {
+    'atom': 'http://www.w3.org/2005/Atom',
+    'yt': 'http://www.youtube.com/xml/schemas/2015',
+    'media': 'http://search.yahoo.com/mrss/',
+}
+
+class FeedError(Exception):
+    """Лента канала недоступна или не разобрана"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def is_channel_id(value):
+    """Проверяет, что строка — ID канала YouTube (UC...), по которому доступна лента"""
+    return bool(value and re.fullmatch(r'UC[\w-]{22}', value))
+
+def parse_channel_feed(content):
+    """Разбирает Atom-ленту канала в список видео (новые первыми) в формате get_latest_videos"""
+    root = ET.fromstring(content)
+    videos = []
+    for entry in root.findall('atom:entry', FEED_NAMESPACES):
+        video_id = entry.findtext('yt:videoId', namespaces=FEED_NAMESPACES)
+        if not video_id:
+            continue
+        link = entry.find("atom:link[@rel='alternate']", FEED_NAMESPACES)
+        statistics = entry.find('media:group/media:community/media:statistics', FEED_NAMESPACES)
+        published = entry.findtext('atom:published', '', FEED_NAMESPACES)
+        try:
+            timestamp = datetime.fromisoformat(published).timestamp() if published else None
+        except ValueError:
+            timestamp = None
+        videos.append({
+            'id': video_id,
+            'title': entry.findtext('atom:title', '', FEED_NAMESPACES),
+            'url': link.get('href') if link is not None else f"https://www.youtube.com/watch?v={video_id}",
+            'upload_date': published[:10].replace('-', '') or None,
+            'duration': None,
+            'view_count': int(statistics.get('views')) if statistics is not None and statistics.get('views') else None,
+            'timestamp': timestamp,
+        })
+    return videos
+
+class ChannelFeedClient:
+    """Чтение Atom-лент каналов условными GET-запросами через общий пул HTTP-соединений"""
+
+    def __init__(self, url_template, timeout, max_connections):
+        self.url_template = url_template
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.client = None
+        self.requests = 0
+        self.not_modified = 0
+        self.failures = 0
+
+    def _get_client(self):
+        # Клиент создается в работающем цикле событий
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                follow_redirects=True,
+            )
+        return self.client
+
+    async def fetch(self, channel_id, state):
+        """Видео из ленты или None, если лента не изменилась (HTTP 304).
+
+        В state хранятся ETag и Last-Modified предыдущего ответа; при ошибке — FeedError."""
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+
+        self.requests += 1
+        try:
+            response = await self._get_client().get(self.url_template.format(channel_id=channel_id), headers=headers)
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise FeedError(f"{type(e).__name__}: {e}") from e
+
+        if response.status_code == 304:
+            self.not_modified += 1
+            return None
+        if response.status_code != 200:
+            self.failures += 1
+            raise FeedError(f"HTTP Error {response.status_code}", response.status_code)
+
+        try:
+            videos = parse_channel_feed(response.content)
+        except ET.ParseError as e:
+            self.failures += 1
+            raise FeedError(f"Не удалось разобрать ленту: {e}") from e
+
+        state['etag'] = response.headers.get('ETag')
+        state['last_modified'] = response.headers.get('Last-Modified')
+        return videos
+
+    async def close(self):
+        """Закрывает пул HTTP-соединений"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def get_stats(self):
+        return {
+            'requests': self.requests,
+            'not_modified': self.not_modified,
+            'failures': self.failures,
+        }
+
+feed_client = ChannelFeedClient(FEED_URL_TEMPLATE, FEED_TIMEOUT, FEED_MAX_CONNECTIONS)
+
 async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подписаться на канал"""
     try:
@@ -663,27 +2064,23 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await update.message.reply_text("⏳ Получаю информацию о канале...")
 
         # Получаем информацию о канале
-        channel_info = get_channel_info(url)
+        channel_info = await metadata_service.channel_info(url)
         if not channel_info:
             await msg.edit_text("❌ Не удалось получить информацию о канале.")
             return
 
-        # Инициализируем подписки для пользователя, если их нет
-        if user_id not in subscriptions:
-            subscriptions[user_id] = {}
-
         # Проверяем, не подписан ли уже пользователь
-        for sub in subscriptions[user_id].values():
+        for sub in subscriptions.get(user_id, {}).values():
             if sub.get('channel_id') == channel_info['channel_id']:
                 await msg.edit_text(f"✅ Вы уже подписаны на канал: {channel_info['title']}")
                 return
 
         # Получаем последние видео
-        latest_videos = get_latest_videos(url, 3)
+        latest_videos = await metadata_service.latest_videos(url, 3)
 
         # Добавляем подписку
         subscription_id = f"sub_{int(time.time())}_{user_id}"
-        subscriptions[user_id][subscription_id] = {
+        subscription_poller.subscribe(user_id, subscription_id, {
             'channel_id': channel_info['channel_id'],
             'title': channel_info['title'],
             'url': channel_info['url'],
@@ -691,7 +2088,7 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'last_check': time.time(),
             'last_video_id': latest_videos[0]['id'] if latest_videos else None,
             'notifications_enabled': True
-        }
+        })
 
         save_subscriptions()
 
@@ -699,14 +2096,10 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"✅ Вы успешно подписались на канал!\n\n"
             f"📺 Канал: {channel_info['title']}\n"
             f"👥 Подписчиков: {channel_info['subscriber_count']:,}\n"
-            f"📅 Бот будет проверять новые видео каждый час.\n\n"
+            f"📅 Бот проверяет новые видео тем чаще, чем активнее канал.\n\n"
             f"🔔 Вы будете получать уведомления о новых видео в этом чате."
         )
 
-        # Запускаем задачу проверки, если она еще не запущена
-        if user_id not in subscription_tasks:
-            asyncio.create_task(check_subscriptions_for_user(user_id, context.application))
-
     except Exception as e:
         logger.error(f"Ошибка в команде subscribe: {e}")
         await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
@@ -740,16 +2133,10 @@ async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         # Отписаться по ID подписки
         sub_id = context.args[0]
-        if sub_id in subscriptions[user_id]:
-            channel_title = subscriptions[user_id][sub_id]['title']
-            del subscriptions[user_id][sub_id]
-
-            # Если подписок не осталось, удаляем пользователя из списка
-            if not subscriptions[user_id]:
-                del subscriptions[user_id]
-
+        sub_data = subscription_poller.unsubscribe(user_id, sub_id)
+        if sub_data:
             save_subscriptions()
-            await update.message.reply_text(f"✅ Вы отписались от канала: {channel_title}")
+            await update.message.reply_text(f"✅ Вы отписались от канала: {sub_data['title']}")
         else:
             await update.message.reply_text("❌ Подписка не найдена.")
 
@@ -819,88 +2206,335 @@ async def toggle_notifications_command(update: Update, context: ContextTypes.DEF
         logger.error(f"Ошибка в команде notifications: {e}")
         await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
 
-async def check_subscriptions_for_user(user_id, app):
-    """Проверяет новые видео для подписок пользователя"""
-    while True:
-        try:
-            if user_id not in subscriptions or not subscriptions[user_id]:
-                logger.info(f"Пользователь {user_id} не имеет подписок, останавливаем проверку")
-                if user_id in subscription_tasks:
-                    del subscription_tasks[user_id]
-                break
-
-            for sub_id, sub_data in list(subscriptions[user_id].items()):
-
-                if not sub_data.get('notifications_enabled', True):
-                    continue
-
-
-                current_time = time.time()
-                if current_time - sub_data['last_check'] < CHECK_INTERVAL:
-                    continue
-
-
-                subscriptions[user_id][sub_id]['last_check'] = current_time
-
-
-                try:
-                    latest_videos = get_latest_videos(sub_data['url'], 5)
-
-                    if latest_videos:
-
-                        last_known_video_id = sub_data.get('last_video_id')
-                        new_videos = []
-
-                        for video in latest_videos:
-                            if video['id'] == last_known_video_id:
-                                break
-                            new_videos.append(video)
-
-                        # Отправляем уведомления о новых видео
-                        if new_videos:
-                            for video in reversed(new_videos):  # От старых к новым
-                                message_text = (
-                                    f"🎬 Новое видео на канале {sub_data['title']}!\n\n"
-                                    f"📹 {video['title']}\n"
-                                    f"⏱ Длительность: {video['duration']} сек\n"
-                                    f"👁 Просмотров: {video.get('view_count', 'N/A')}\n\n"
-                                    f"🔗 Ссылка: {video['url']}"
-                                )
-
-                                keyboard = [
-                                    [InlineKeyboardButton("📥 Скачать видео", callback_data=f"subscribe_dl:{video['url']}:{user_id}")],
-                                    [InlineKeyboardButton("🔕 Отключить уведомления", callback_data=f"unsubscribe:{sub_id}:{user_id}")]
-                                ]
-
-                                try:
-                                    await app.bot.send_message(
-                                        chat_id=int(user_id),
-                                        text=message_text,
-                                        reply_markup=InlineKeyboardMarkup(keyboard),
-                                        disable_web_page_preview=True
-                                    )
-
-
-                                    await asyncio.sleep(1)
-
-                                except Exception as e:
-                                    logger.error(f"Ошибка при отправке уведомления: {e}")
-
-
-                            subscriptions[user_id][sub_id]['last_video_id'] = new_videos[0]['id']
-                            save_subscriptions()
+async def send_video_notification(app, user_id, sub_id, sub_data, video):
+    """Отправляет подписчику уведомление о новом видео; при RetryAfter ждет и повторяет один раз"""
+    # В Atom-ленте нет длительности, а просмотров может не быть
+    duration_text = f"⏱ Длительность: {video['duration']} сек\n" if video.get('duration') else ""
+    view_count = video.get('view_count')
+    message_text = (
+        f"🎬 Новое видео на канале {sub_data['title']}!\n\n"
+        f"📹 {video['title']}\n"
+        f"{duration_text}"
+        f"👁 Просмотров: {view_count if view_count is not None else 'N/A'}\n\n"
+        f"🔗 Ссылка: {video['url']}"
+    )
 
-                except Exception as e:
-                    logger.error(f"Ошибка при проверке канала {sub_data['title']}: {e}")
+    keyboard = [
+        [InlineKeyboardButton("📥 Скачать видео", callback_data=f"subscribe_dl:{video['url']}:{user_id}")],
+        [InlineKeyboardButton("🔕 Отключить уведомления", callback_data=f"unsubscribe:{sub_id}:{user_id}")]
+    ]
 
+    for attempt in range(2):
+        try:
+            await app.bot.send_message(
+                chat_id=int(user_id),
+                text=message_text,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                disable_web_page_preview=True
+            )
+            return True
+        except RetryAfter as e:
+            if attempt:
+                logger.error(f"Telegram ограничил отправку уведомлений пользователю {user_id}: {e}")
+                return False
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления: {e}")
+            return False
+
+class SubscriptionPoller:
+    """Проверка подписок по каналам: каждый канал загружается один раз за свой интервал,
+    новые видео рассылаются всем его подписчикам.
+
+    Время следующей проверки каналов хранится в куче; интервал зависит от частоты загрузок
+    канала, числа подписчиков и недавней активности. Новые видео ищутся в Atom-ленте канала;
+    yt-dlp используется, только если лента недоступна."""
+
+    def __init__(self, interval, min_interval, max_interval, jitter, polls_per_minute,
+                 concurrency, notify_delay, feed_client, seen_limit):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.notify_delay = notify_delay
+        self.feed_client = feed_client
+        self.seen_limit = seen_limit
+        # Обратный индекс: канал -> {(user_id, sub_id)}
+        self.channels = {}
+        self.last_check = {}
+        # Куча (время проверки, канал); запись устарела, если не совпадает с next_check
+        self.heap = []
+        self.next_check = {}
+        # Каналы, которые проверяются прямо сейчас (их нет в куче)
+        self.polling = set()
+        self.changed = asyncio.Event()
+        self.budget = TokenBucket(polls_per_minute / 60, max(1, polls_per_minute // 6))
+        self.tasks = set()
+        self.budget_waits = 0
+        self.fetches = 0
+        self.fallbacks = 0
+        self.notifications = 0
+
+    @staticmethod
+    def get_channel_key(sub_data):
+        return sub_data.get('channel_id') or sub_data['url']
+
+    def _index(self, user_id, sub_id):
+        sub_data = subscriptions[user_id][sub_id]
+        key = self.get_channel_key(sub_data)
+        self.channels.setdefault(key, set()).add((user_id, sub_id))
+        # Канал проверяется по самой давней проверке среди его подписчиков
+        self.last_check[key] = min(self.last_check.get(key, sub_data['last_check']), sub_data['last_check'])
+        return key
+
+    def _unindex(self, user_id, sub_id, sub_data):
+        key = self.get_channel_key(sub_data)
+        members = self.channels.get(key)
+        if members is None:
+            return
+        members.discard((user_id, sub_id))
+        if not members:
+            del self.channels[key]
+            self.last_check.pop(key, None)
+            # Запись в куче станет устаревшей и будет пропущена
+            self.next_check.pop(key, None)
+            if channel_state.pop(key, None) is not None:
+                save_channel_state()
+
+    def rebuild(self):
+        """Строит обратный индекс по загруженным подпискам и расписание проверок"""
+        self.channels = {}
+        self.last_check = {}
+        self.heap = []
+        self.next_check = {}
+        for user_id, user_subscriptions in subscriptions.items():
+            for sub_id in user_subscriptions:
+                self._index(user_id, sub_id)
+        now = time.time()
+        for key in self.channels:
+            self.schedule(key, now)
+        logger.info(f"Индекс подписок: {len(self.channels)} каналов")
+
+    def subscribe(self, user_id, sub_id, sub_data):
+        subscriptions.setdefault(user_id, {})[sub_id] = sub_data
+        key = self._index(user_id, sub_id)
+        if key not in self.next_check and key not in self.polling:
+            self.schedule(key, time.time())
+
+    def get_interval(self, key, now):
+        """Интервал проверки канала по частоте его загрузок, недавней активности и числу подписчиков"""
+        uploads = channel_state.get(key, {}).get('uploads', [])
+        if len(uploads) >= 2:
+            # Средний промежуток между видео; если канал давно молчит — не меньше времени с последнего видео
+            cadence = max((uploads[-1] - uploads[0]) / (len(uploads) - 1), now - uploads[-1])
+            interval = cadence / SUBSCRIPTION_CHECKS_PER_UPLOAD
+        else:
+            interval = self.interval
+        # Видео часто выходят сериями, поэтому недавно активный канал проверяем чаще
+        if uploads and now - uploads[-1] < SUBSCRIPTION_ACTIVE_WINDOW:
+            interval /= 2
+        # Уведомления популярного канала ждет больше людей
+        interval /= 1 + math.log10(max(len(self.channels.get(key, ())), 1))
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def schedule(self, key, now):
+        """Назначает следующую проверку канала (от его последней проверки, со случайным разбросом)"""
+        interval = self.get_interval(key, now) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        next_time = max(self.last_check.get(key, now) + interval, now)
+        self.next_check[key] = next_time
+        heapq.heappush(self.heap, (next_time, key))
+        self.changed.set()
+
+    def unsubscribe(self, user_id, sub_id):
+        """Удаляет подписку; возвращает ее данные или None"""
+        sub_data = subscriptions.get(user_id, {}).pop(sub_id, None)
+        if sub_data is None:
+            return None
+        self._unindex(user_id, sub_id, sub_data)
+        # Если подписок не осталось, удаляем пользователя из списка
+        if not subscriptions[user_id]:
+            del subscriptions[user_id]
+        return sub_data
+
+    def unsubscribe_all(self, user_id):
+        for sub_id, sub_data in subscriptions.pop(user_id, {}).items():
+            self._unindex(user_id, sub_id, sub_data)
+
+    def get_subscribers(self, key):
+        """Подписчики канала с включенными уведомлениями: [(user_id, sub_id, sub_data)]"""
+        subscribers = []
+        for user_id, sub_id in self.channels.get(key, ()):
+            sub_data = subscriptions.get(user_id, {}).get(sub_id)
+            if sub_data and sub_data.get('notifications_enabled', True):
+                subscribers.append((user_id, sub_id, sub_data))
+        return subscribers
+
+    async def fetch_latest_videos(self, key, url, state):
+        """Последние видео канала: из ленты, а при ее ошибке — через yt-dlp.
+
+        Пустой список — новых данных нет (лента не изменилась или канал недоступен)."""
+        if is_channel_id(key):
+            try:
+                return await self.feed_client.fetch(key, state) or []
+            except FeedError as e:
+                if e.status == 429:
+                    # Запрос через yt-dlp после 429 только усилит ограничение
+                    rate_limiter.report_error('youtube', e)
+                    return []
+                logger.warning(f"Лента канала {key} недоступна, используем yt-dlp: {e}")
+        self.fallbacks += 1
+        return await metadata_service.latest_videos(url, 5)
+
+    @staticmethod
+    def get_videos_after(latest_videos, last_video_id):
+        """Видео новее last_video_id (все, если он не задан)"""
+        new_videos = []
+        for video in latest_videos:
+            if video['id'] == last_video_id:
+                return new_videos
+            new_videos.append(video)
+        # Известного видео уже нет в ленте — не присылаем все видео канала разом
+        return new_videos if last_video_id is None else []
+
+    def take_new_videos(self, state, latest_videos, subscribers):
+        """Отбирает еще не известные видео для каждого подписчика: {(user_id, sub_id): [видео]}.
+
+        Запоминает ID видео канала (не больше seen_limit)."""
+        seen = state.get('seen')
+        if seen is None:
+            # Первая проверка канала: у каждого подписчика новыми считаются видео новее его последнего известного
+            new_by_subscriber = {
+                (user_id, sub_id): self.get_videos_after(latest_videos, sub_data.get('last_video_id'))
+                for user_id, sub_id, sub_data in subscribers
+            }
+            seen = []
+        else:
+            seen_ids = set(seen)
+            new_videos = [video for video in latest_videos if video['id'] not in seen_ids]
+            new_by_subscriber = {(user_id, sub_id): new_videos for user_id, sub_id, sub_data in subscribers}
+
+        latest_ids = [video['id'] for video in latest_videos]
+        latest_set = set(latest_ids)
+        # Все видео текущей ленты помним всегда, иначе они снова покажутся новыми
+        limit = max(self.seen_limit, len(latest_ids))
+        state['seen'] = (latest_ids + [video_id for video_id in seen if video_id not in latest_set])[:limit]
+        return new_by_subscriber
+
+    def record_uploads(self, state, latest_videos, new_ids, now):
+        """Запоминает время последних публикаций канала для оценки частоты загрузок"""
+        timestamps = set(state.get('uploads', []))
+        for video in latest_videos:
+            if video.get('timestamp'):
+                timestamps.add(video['timestamp'])
+            elif video['id'] in new_ids:
+                # Без даты публикации (yt-dlp) считаем временем публикации момент обнаружения
+                timestamps.add(now)
+        state['uploads'] = sorted(timestamps)[-SUBSCRIPTION_CADENCE_SAMPLES:]
+
+    async def poll_channel(self, app, key, semaphore):
+        """Загружает последние видео канала и рассылает новые каждому подписчику"""
+        subscribers = self.get_subscribers(key)
+        if not subscribers:
+            return
+        try:
+            state = channel_state.setdefault(key, {})
+            async with semaphore:
+                latest_videos = await self.fetch_latest_videos(key, subscribers[0][2]['url'], state)
+            self.fetches += 1
 
+            current_time = time.time()
+            self.last_check[key] = current_time
+            for user_id, sub_id, sub_data in subscribers:
+                sub_data['last_check'] = current_time
+
+            if latest_videos:
+                new_by_subscriber = self.take_new_videos(state, latest_videos, subscribers)
+                new_ids = {video['id'] for new_videos in new_by_subscriber.values() for video in new_videos}
+                self.record_uploads(state, latest_videos, new_ids, current_time)
+                for user_id, sub_id, sub_data in subscribers:
+                    for video in reversed(new_by_subscriber[(user_id, sub_id)]):  # От старых к новым
+                        if await send_video_notification(app, user_id, sub_id, sub_data, video):
+                            self.notifications += 1
+                        await asyncio.sleep(self.notify_delay)
+                    sub_data['last_video_id'] = latest_videos[0]['id']
+
+            save_channel_state()
             save_subscriptions()
+        except Exception as e:
+            logger.error(f"Ошибка при проверке канала {subscribers[0][2]['title']}: {e}")
 
-            await asyncio.sleep(CHECK_INTERVAL)
+    async def check_channel(self, app, key, semaphore):
+        """Проверяет канал и назначает следующую проверку"""
+        self.polling.add(key)
+        try:
+            await self.poll_channel(app, key, semaphore)
+        finally:
+            self.polling.discard(key)
+            if key in self.channels:
+                # Следующая проверка отсчитывается от этой, даже если она не удалась
+                now = time.time()
+                self.last_check[key] = now
+                self.schedule(key, now)
+
+    async def wait_next(self):
+        """Ждет канал, которому пора на проверку, и забирает его из кучи"""
+        while True:
+            self.changed.clear()
+            while self.heap and self.next_check.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is not None and delay <= 0:
+                next_time, key = heapq.heappop(self.heap)
+                del self.next_check[key]
+                return key
+            try:
+                # Новая подписка может оказаться раньше текущей вершины кучи
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
-        except Exception as e:
-            logger.error(f"Ошибка в задаче проверки подписок для пользователя {user_id}: {e}")
-            await asyncio.sleep(300)
+    async def run(self, app):
+        """Фоновый цикл проверки подписок"""
+        self.rebuild()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            try:
+                key = await self.wait_next()
+                # Общий бюджет проверок: после простоя каналы не проверяются все разом
+                wait = self.budget.reserve(time.monotonic())
+                if wait > 0:
+                    self.budget_waits += 1
+                    await asyncio.sleep(wait)
+                task = asyncio.create_task(self.check_channel(app, key, semaphore))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в задаче проверки подписок: {e}")
+                await asyncio.sleep(300)
+
+    def get_stats(self):
+        now = time.time()
+        intervals = [self.get_interval(key, now) for key in self.channels]
+        return {
+            'channels': len(self.channels),
+            'subscriptions': sum(len(members) for members in self.channels.values()),
+            'next_in': max(min(self.next_check.values()) - now, 0) if self.next_check else None,
+            'min_interval': min(intervals) if intervals else None,
+            'max_interval': max(intervals) if intervals else None,
+            'budget_waits': self.budget_waits,
+            'fetches': self.fetches,
+            'fallbacks': self.fallbacks,
+            'notifications': self.notifications,
+        }
+
+subscription_poller = SubscriptionPoller(
+    CHECK_INTERVAL, SUBSCRIPTION_MIN_INTERVAL, SUBSCRIPTION_MAX_INTERVAL, SUBSCRIPTION_INTERVAL_JITTER,
+    SUBSCRIPTION_POLLS_PER_MINUTE, SUBSCRIPTION_FETCH_CONCURRENCY, SUBSCRIPTION_NOTIFY_DELAY,
+    feed_client, FEED_SEEN_IDS,
+)
 
 async def handle_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback-кнопок для подписок"""
@@ -918,24 +2552,19 @@ async def handle_subscription_callback(update: Update, context: ContextTypes.DEF
                 return
 
             sub_id = parts[1]
-            user_id = parts[2]
-
-            if user_id in subscriptions and sub_id in subscriptions[user_id]:
-                channel_title = subscriptions[user_id][sub_id]['title']
-                del subscriptions[user_id][sub_id]
-
-                if not subscriptions[user_id]:
-                    del subscriptions[user_id]
+            user_id = parts[2]
 
+            sub_data = subscription_poller.unsubscribe(user_id, sub_id)
+            if sub_data:
                 save_subscriptions()
-                await query.edit_message_text(f"✅ Вы отписались от канала: {channel_title}")
+                await query.edit_message_text(f"✅ Вы отписались от канала: {sub_data['title']}")
             else:
                 await query.edit_message_text("❌ Подписка не найдена.")
 
         elif action == "unsubscribe_all":
             user_id = parts[1]
             if user_id in subscriptions:
-                del subscriptions[user_id]
+                subscription_poller.unsubscribe_all(user_id)
                 save_subscriptions()
                 await query.edit_message_text("✅ Вы отписались от всех каналов.")
             else:
@@ -1006,19 +2635,8 @@ async def handle_subscription_callback(update: Update, context: ContextTypes.DEF
 
             # Добавляем в очередь загрузки
             url_type = get_url_type(url)
-            task = (user_id, url, "best", None, url_type, query.message, False)
-            await download_queue.put(task)
-
-            update_queue_positions()
-            position = queue_status.get(user_id, 0)
-
-            if position > 0:
-                await query.edit_message_text(f"📋 Запрос на скачивание добавлен в очередь. Позиция: {position}")
-            else:
-                await query.edit_message_text("📋 Запрос на скачивание добавлен в очередь.")
-
-            if not queue_processing:
-                asyncio.create_task(process_download_queue(context.application))
+            task = DownloadTask(user_id, url, "best", None, url_type, query.message, False)
+            await enqueue_download(task, query.edit_message_text, "📋 Запрос на скачивание добавлен в очередь.")
 
     except Exception as e:
         logger.error(f"Ошибка в обработке подписок callback: {e}")
@@ -1026,22 +2644,25 @@ async def handle_subscription_callback(update: Update, context: ContextTypes.DEF
 
 
 
-async def download_video_async(url, format_type, format_id=None, url_type='youtube', message=None):
+async def download_video_async(url, format_type, format_id=None, url_type='youtube', message=None, info=None, work_dir='.',
+                               job=None, reply_markup=None):
     """Асинхронная обертка для скачивания видео с прогрессом"""
     loop = asyncio.get_event_loop()
 
 
     progress_hook = None
-    if message:
-        progress = DownloadProgress(message)
+    if message or job:
+        progress = DownloadProgress(message, job=job, reply_markup=reply_markup)
         progress.set_loop(loop)
         progress_hook = progress.progress_hook
 
+    # Ждем, только если лимит запросов к платформе исчерпан
+    await rate_limiter.acquire(url_type)
+
     try:
-        result = await loop.run_in_executor(
-            download_executor,
+        result = await executors['download'].run(
             download_video_sync,
-            url, format_type, format_id, url_type, progress_hook
+            url, format_type, format_id, url_type, progress_hook, info, work_dir
         )
         return result
     except Exception as e:
@@ -1050,23 +2671,27 @@ async def download_video_async(url, format_type, format_id=None, url_type='youtu
         logger.error(f"Ошибка в асинхронном скачивании: {e}")
         raise e
 
-async def download_audio_async(url, url_type, message=None):
+async def download_audio_async(url, url_type, message=None, info=None, work_dir='.', job=None, reply_markup=None):
     """Асинхронная обертка для скачивания аудио с прогрессом"""
     loop = asyncio.get_event_loop()
 
     progress_hook = None
-    if message:
-        progress = DownloadProgress(message)
+    if message or job:
+        progress = DownloadProgress(message, job=job, reply_markup=reply_markup)
         progress.set_loop(loop)
         progress_hook = progress.progress_hook
 
+    # Ждем, только если лимит запросов к платформе исчерпан
+    await rate_limiter.acquire(url_type)
+
     try:
-        result = await loop.run_in_executor(
-            download_executor,
+        filename, info = await executors['download'].run(
             download_audio_sync,
-            url, url_type, progress_hook
+            url, url_type, progress_hook, info, work_dir, False
         )
-        return result
+        # Конвертация в mp3 идет в отдельном пуле и не занимает поток загрузок
+        filename = await executors['postprocess'].run(extract_audio_sync, filename)
+        return filename, info
     except Exception as e:
         if "File size exceeded" in str(e):
             raise Exception("Файл слишком большой для Telegram (превышает 50 МБ)")
@@ -1076,43 +2701,11 @@ async def download_audio_async(url, url_type, message=None):
 # Скачивание видео
 def download_video(url, format_type, format_id=None, url_type='youtube'):
     """Скачивает видео по URL с выбранным качеством"""
-    # Добавляем случайную задержку для избежания блокировок
-    time.sleep(random.uniform(1, 3))
-
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'outtmpl': '%(title)s.%(ext)s',
-        # Добавляем параметры для работы с SSL
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
-
-    # Добавляем cookies для YouTube, если доступны
-    if url_type in ['youtube', 'youtube_music']:
-        for cookies_file in COOKIES_FILES:
-            if os.path.exists(cookies_file):
-                ydl_opts['cookiefile'] = cookies_file
-                break
-
-    # Настраиваем формат для скачивания
-    if format_type == 'best':
-        ydl_opts['format'] = 'best[height<=1080]'  # Лучшее качество до 1080p
-    elif format_type == 'max':
-        ydl_opts['format'] = 'best'  # Абсолютно лучшее качество без ограничений
-    elif format_type == 'audio':
-        ydl_opts['format'] = 'bestaudio/best'
-        ydl_opts['postprocessors'] = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }]
-    elif format_id:
-        ydl_opts['format'] = format_id
+    # Ждем, только если лимит запросов к платформе исчерпан
+    rate_limiter.acquire_sync(url_type)
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with acquire_download_ydl(format_type, format_id, url_type) as ydl:
             info = ydl.extract_info(url, download=True)
             title = info.get('title', 'video')
             filename = ydl.prepare_filename(info)
@@ -1125,39 +2718,17 @@ def download_video(url, format_type, format_id=None, url_type='youtube'):
             return filename, title
     except Exception as e:
         logger.error(f"Ошибка при скачивании видео: {e}")
+        rate_limiter.report_error(url_type, e)
         raise e
 
 # Скачивание только аудио
 def download_audio(url, url_type):
     """Скачивает только аудио из видео"""
-    # Добавляем случайную задержку для избежания блокировок
-    time.sleep(random.uniform(1, 3))
-
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'format': 'bestaudio/best',
-        'outtmpl': '%(title)s.%(ext)s',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        # Добавляем параметры для работы с SSL
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
-
-    # Добавляем cookies для YouTube, если доступны
-    if url_type in ['youtube', 'youtube_music']:
-        for cookies_file in COOKIES_FILES:
-            if os.path.exists(cookies_file):
-                ydl_opts['cookiefile'] = cookies_file
-                break
+    # Ждем, только если лимит запросов к платформе исчерпан
+    rate_limiter.acquire_sync(url_type)
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with acquire_download_ydl('audio', None, url_type) as ydl:
             info = ydl.extract_info(url, download=True)
             title = info.get('title', 'audio')
             filename = ydl.prepare_filename(info)
@@ -1169,27 +2740,13 @@ def download_audio(url, url_type):
             return filename, title
     except Exception as e:
         logger.error(f"Ошибка при скачивании аудио: {e}")
+        rate_limiter.report_error(url_type, e)
         raise e
 
 
 def search_youtube_music(query, max_results=5):
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': True,
-        'skip_download': True,
-        'no_check_certificate': True,
-        'socket_timeout': 30,
-        'source_address': '0.0.0.0',
-    }
-
-    for cookies_file in COOKIES_FILES:
-        if os.path.exists(cookies_file):
-            ydl_opts['cookiefile'] = cookies_file
-            break
-
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.acquire('search', cookies=True) as ydl:
             info = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
 
             if not info or 'entries' not in info:
@@ -1202,41 +2759,757 @@ def search_youtube_music(query, max_results=5):
 
 # Функция добавления пользователя
 def add_user(user_id, username, first_name, last_name):
-    """Добавляет пользователя в база данных"""
-    if str(user_id) not in user_data:
-        user_data[str(user_id)] = {
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name,
-            'join_date': datetime.now().isoformat(),
-            'download_count': 0
+    """Добавляет пользователя в базу данных"""
+    try:
+        user_store.upsert(user_id, username, first_name, last_name)
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
+
+class QueueFullError(Exception):
+    """Пользователь превысил лимит заданий в очереди"""
+
+class QueueBusyError(Exception):
+    """Очередь перегружена: превышен размер или прогнозируемое ожидание"""
+
+def get_flow_key(task):
+    """Ключ справедливого обслуживания: чат для групп, пользователь для личных чатов и инлайна"""
+    chat_id = getattr(task.message, 'chat_id', None)
+    # У групп и супергрупп в Telegram отрицательные ID
+    if not task.is_inline and chat_id is not None and chat_id < 0:
+        return f"chat:{chat_id}"
+    return f"user:{task.user_id}"
+
+class JobCostModel:
+    """Прогноз длительности задания по метаданным видео и наблюдаемой скорости загрузки и отправки"""
+
+    def __init__(self, download_speed, upload_speed, overhead, default_size, smoothing):
+        self.default_download_speed = download_speed
+        self.download_speed = {}  # url_type -> байт/с, экспоненциальное среднее
+        self.upload_speed = upload_speed
+        self.overhead = overhead
+        self.default_size = default_size
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _format_size(fmt, duration):
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size and fmt.get('tbr') and duration:
+            # tbr указан в кбит/с
+            size = fmt['tbr'] * 1000 / 8 * duration
+        return size or 0
+
+    def estimate_size(self, info, format_type, format_id):
+        """Оценивает размер загрузки в байтах или возвращает None, если данных недостаточно"""
+        if not info:
+            return None
+        duration = info.get('duration') or 0
+        formats = info.get('formats') or []
+
+        if format_type == 'audio':
+            audio_formats = [fmt for fmt in formats if fmt.get('vcodec') == 'none']
+            if audio_formats:
+                size = self._format_size(audio_formats[-1], duration)
+                if size:
+                    return size
+            # После конвертации в mp3 192 кбит/с
+            return 192000 / 8 * duration if duration else None
+
+        if format_id and format_type not in ('best', 'max', 'tiktok'):
+            by_id = {fmt.get('format_id'): fmt for fmt in formats}
+            size = sum(self._format_size(by_id[part], duration) for part in format_id.split('+') if part in by_id)
+            if size:
+                return size
+        elif formats:
+            # Форматы в info отсортированы от худшего к лучшему, как их выбирает best[height<=1080]
+            progressive = [
+                fmt for fmt in formats
+                if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none'
+                and (format_type == 'max' or (fmt.get('height') or 0) <= 1080)
+            ]
+            if progressive:
+                size = self._format_size(progressive[-1], duration)
+                if size:
+                    return size
+
+        return self._format_size(info, duration) or None
+
+    def predict(self, task, info=None):
+        """Ожидаемая длительность задания в секундах"""
+        # Уже отправленный формат пересылается по file_id без загрузки
+        format_key = get_format_key("best" if task.url_type == "tiktok" else task.format_type, task.format_id)
+        if video_cache_store:
+            cache_entry = video_cache_store.get(get_cache_key(task.url, format_key))
+            if cache_entry and is_cache_entry_available(cache_entry):
+                return self.overhead
+
+        if info is None:
+            info = get_cached_video_info(task.url)
+        size = self.estimate_size(info, task.format_type, task.format_id) or self.default_size
+        download_speed = self.get_download_speed(task.url_type)
+        # Загрузка прерывается на лимите Telegram, а такой файл уже не отправляется
+        if size > 50 * 1024 * 1024:
+            return self.overhead + 50 * 1024 * 1024 / download_speed
+        return self.overhead + size / download_speed + size / self.upload_speed
+
+    def get_download_speed(self, url_type):
+        with self.lock:
+            return self.download_speed.get(url_type, self.default_download_speed)
+
+    def observe(self, url_type, size, download_seconds, upload_seconds):
+        """Учитывает фактическую скорость завершенного задания"""
+        if size <= 0:
+            return
+        with self.lock:
+            if download_seconds > 0:
+                speed = self.download_speed.get(url_type, self.default_download_speed)
+                self.download_speed[url_type] = speed + self.smoothing * (size / download_seconds - speed)
+            if upload_seconds > 0:
+                self.upload_speed += self.smoothing * (size / upload_seconds - self.upload_speed)
+
+job_cost_model = JobCostModel(
+    DEFAULT_DOWNLOAD_SPEED, DEFAULT_UPLOAD_SPEED, JOB_OVERHEAD_SECONDS, DEFAULT_JOB_SIZE, THROUGHPUT_SMOOTHING
+)
+
+def get_job_key(task):
+    """Ключ для объединения одинаковых заданий: каноничный ID видео и формат"""
+    format_key = get_format_key("best" if task.url_type == "tiktok" else task.format_type, task.format_id)
+    return f"{get_info_cache_key(task.url)}|{format_key}"
+
+class DownloadTask:
+    """Запрос на загрузку: кто запросил, что скачать и какое сообщение обновлять"""
+    __slots__ = ('user_id', 'url', 'format_type', 'format_id', 'url_type', 'message', 'is_inline')
+
+    def __init__(self, user_id, url, format_type, format_id, url_type, message, is_inline):
+        self.user_id = user_id
+        self.url = url
+        self.format_type = format_type
+        self.format_id = format_id
+        self.url_type = url_type
+        self.message = message
+        self.is_inline = is_inline
+
+    def __repr__(self):
+        return f"DownloadTask(user_id={self.user_id}, url={self.url!r}, format={self.format_type}:{self.format_id})"
+
+# Состояния задания и допустимые переходы между ними
+JOB_QUEUED = 'queued'
+JOB_EXTRACTING = 'extracting'
+JOB_DOWNLOADING = 'downloading'
+JOB_POSTPROCESSING = 'postprocessing'
+JOB_UPLOADING = 'uploading'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_TRANSITIONS = {
+    # Формат, уже отправленный ранее, пересылается по file_id сразу из очереди
+    JOB_QUEUED: {JOB_EXTRACTING, JOB_UPLOADING, JOB_FAILED, JOB_CANCELLED},
+    JOB_EXTRACTING: {JOB_DOWNLOADING, JOB_POSTPROCESSING, JOB_UPLOADING, JOB_FAILED, JOB_CANCELLED},
+    # Видео и аудио скачиваются отдельными файлами, поэтому загрузка и обработка могут чередоваться
+    JOB_DOWNLOADING: {JOB_POSTPROCESSING, JOB_UPLOADING, JOB_FAILED, JOB_CANCELLED},
+    JOB_POSTPROCESSING: {JOB_DOWNLOADING, JOB_UPLOADING, JOB_FAILED, JOB_CANCELLED},
+    # Если файл из кэша отправить не удалось, видео скачивается заново
+    JOB_UPLOADING: {JOB_EXTRACTING, JOB_DONE, JOB_FAILED, JOB_CANCELLED},
+    JOB_DONE: set(),
+    JOB_FAILED: set(),
+    JOB_CANCELLED: set(),
+}
+JOB_FINAL_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+JOB_STATE_LABELS = {
+    JOB_QUEUED: "в очереди",
+    JOB_EXTRACTING: "получение информации",
+    JOB_DOWNLOADING: "загружается",
+    JOB_POSTPROCESSING: "обработка",
+    JOB_UPLOADING: "отправляется",
+    JOB_DONE: "готово",
+    JOB_FAILED: "ошибка",
+    JOB_CANCELLED: "отменено",
+}
+
+class DownloadJob:
+    """Задание очереди загрузок: запрос владельца, присоединенные запросы, состояние и счетчики"""
+    __slots__ = (
+        'job_id', 'user_id', 'flow_key', 'key', 'task', 'followers', 'state', 'enqueued_at', 'started_at',
+        'finished_at', 'cost', 'retries', 'downloaded_bytes', 'total_bytes', 'uploaded_bytes', 'cancel_event'
+    )
+
+    def __init__(self, job_id, task, cost):
+        self.job_id = job_id
+        self.user_id = task.user_id
+        self.flow_key = get_flow_key(task)
+        self.key = get_job_key(task)
+        self.task = task
+        self.followers = []  # запросы того же видео от других пользователей, получат файл по file_id
+        self.state = JOB_QUEUED
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cost = cost  # прогнозируемая длительность, секунды
+        self.retries = 0  # сколько раз выполнение прерывалось перезапуском бота
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.uploaded_bytes = 0
+        # Проверяется в progress_hook yt-dlp, чтобы прервать загрузку из потока
+        self.cancel_event = threading.Event()
+
+    def __repr__(self):
+        return f"DownloadJob(#{self.job_id}, {self.state}, {self.task!r})"
+
+    def set_state(self, state):
+        """Переводит задание в новое состояние; недопустимый переход логируется и игнорируется"""
+        if state == self.state:
+            return True
+        if state not in JOB_TRANSITIONS[self.state]:
+            logger.warning(f"Недопустимый переход задания #{self.job_id}: {self.state} -> {state}")
+            return False
+        self.state = state
+        if state in JOB_FINAL_STATES:
+            self.finished_at = time.time()
+        return True
+
+    def user_ids(self):
+        return {self.user_id}.union(task.user_id for task in self.followers)
+
+    def score(self, now, aging_factor):
+        """Приоритет для планировщика: чем меньше, тем раньше; ожидание постепенно снижает оценку"""
+        return self.cost - aging_factor * (now - self.enqueued_at)
+
+    def rank(self, aging_factor):
+        """score без общего для всех заданий слагаемого -aging_factor * now: порядок по нему не меняется со временем"""
+        return self.cost + aging_factor * self.enqueued_at
+
+class JobJournal:
+    """Журнал заданий очереди на SQLite: по строке на запрос, пока он не выполнен или не отменен"""
+
+    # Колонки, добавленные после первой версии схемы
+    ADDED_COLUMNS = (
+        ('retries', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "job_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, "
+                "chat_id INTEGER, "
+                "message_id INTEGER, "
+                "url TEXT NOT NULL, "
+                "format_type TEXT, "
+                "format_id TEXT, "
+                "url_type TEXT, "
+                "is_inline INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL, "
+                "retries INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in self.ADDED_COLUMNS:
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_job_id ON jobs (job_id)")
+
+    def add(self, job_id, task):
+        """Записывает запрос задания job_id"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, user_id, chat_id, message_id, url, format_type, format_id, url_type, "
+                "is_inline, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, task.user_id, getattr(task.message, 'chat_id', None), getattr(task.message, 'message_id', None),
+                 task.url, task.format_type, task.format_id, task.url_type, int(bool(task.is_inline)), time.time())
+            )
+
+    def remove_job(self, job_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def remove_user(self, job_id, user_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE job_id = ? AND user_id = ?", (job_id, user_id))
+
+    def remove_row(self, row_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+
+    def add_attempt(self, job_id):
+        """Учитывает начало выполнения: если бот упадет, при восстановлении это будет повторная попытка"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET retries = retries + 1 WHERE job_id = ?", (job_id,))
+
+    def set_retries(self, job_id, retries):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET retries = ? WHERE job_id = ?", (retries, job_id))
+
+    def max_job_id(self):
+        with self.lock:
+            return self.conn.execute("SELECT MAX(job_id) FROM jobs").fetchone()[0] or 0
+
+    def all_rows(self):
+        """Все незавершенные запросы в порядке добавления"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, user_id, chat_id, message_id, url, format_type, format_id, url_type, is_inline, retries "
+                "FROM jobs ORDER BY id"
+            ).fetchall()
+
+class DownloadQueue:
+    """Очередь загрузок: круги по пользователям (и групповым чатам), внутри круга — сначала короткие задания"""
+
+    def __init__(self, workers, max_running_per_flow, max_outstanding_per_user, max_size, max_wait, cost_model,
+                 aging_factor):
+        self.workers = workers
+        self.max_running_per_flow = max_running_per_flow
+        self.max_outstanding_per_user = max_outstanding_per_user
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.cost_model = cost_model
+        self.aging_factor = aging_factor
+        self.jobs = {}  # job_id -> DownloadJob, ожидающие задания
+        self.running = {}  # job_id -> DownloadJob, задания в работе
+        self.flows = {}  # flow_key -> отсортированный список (rank, job_id) ожидающих заданий
+        # Сколько заданий поток получил: за круг каждый поток обслуживается один раз
+        self.flow_rounds = {}
+        # Куча (круг, rank первого задания, его job_id, flow_key); записи, не совпадающие
+        # с текущим состоянием потока, устарели и пропускаются
+        self.flow_heap = []
+        self.pending_cost = 0  # сумма прогнозов ожидающих заданий
+        self.running_per_flow = {}
+        self.by_user = {}  # user_id -> {job_id: None} в порядке добавления
+        self.by_key = {}  # get_job_key -> ожидающее или выполняемое задание
+        self.job_ids = itertools.count(1)
+        self.changed = asyncio.Event()
+        self.admitted = 0
+        self.shed = {'user_limit': 0, 'capacity': 0, 'deadline': 0}
+        self.journal = None
+
+    def attach_journal(self, journal):
+        """Подключает журнал; номера новых заданий продолжают номера из журнала"""
+        self.journal = journal
+        self.job_ids = itertools.count(max(journal.max_job_id(), next(self.job_ids) - 1) + 1)
+
+    def put(self, task, admission=True):
+        """Добавляет задание или присоединяет запрос к такому же заданию; возвращает задание.
+
+        Бросает QueueFullError при превышении лимита пользователя и QueueBusyError при перегрузке.
+        admission=False пропускает проверки для заданий, восстановленных из журнала."""
+        user_id = task.user_id
+        outstanding = len(self.by_user.get(user_id, ())) + len(self.running_for_user(user_id))
+        if admission and outstanding >= self.max_outstanding_per_user:
+            self.shed['user_limit'] += 1
+            raise QueueFullError(f"У пользователя {user_id} уже {outstanding} незавершенных заданий")
+
+        job = self.by_key.get(get_job_key(task))
+        if job:
+            # Присоединение не добавляет работы, поэтому общие лимиты не проверяются
+            job.followers.append(task)
+            if job.job_id in self.jobs:
+                self.by_user.setdefault(user_id, {})[job.job_id] = None
+            self.admitted += 1
+            if self.journal:
+                self.journal.add(job.job_id, task)
+            return job
+
+        if admission and self.max_size and len(self.jobs) >= self.max_size:
+            self.shed['capacity'] += 1
+            raise QueueBusyError(f"В очереди уже {len(self.jobs)} заданий")
+        wait = self.predicted_wait()
+        if admission and self.max_wait and wait > self.max_wait:
+            self.shed['deadline'] += 1
+            raise QueueBusyError(f"Прогнозируемое ожидание {wait:.0f} сек")
+
+        job_id = next(self.job_ids)
+        job = DownloadJob(job_id, task, self.cost_model.predict(task))
+        if self.journal:
+            self.journal.add(job_id, task)
+        self.admitted += 1
+        self.jobs[job_id] = job
+        self.pending_cost += job.cost
+        self.by_key[job.key] = job
+        self.by_user.setdefault(user_id, {})[job_id] = None
+        self._link_flow(job)
+        self.changed.set()
+        return job
+
+    def _push_flow(self, flow_key):
+        """Добавляет в кучу запись о текущем состоянии потока"""
+        rank, job_id = self.flows[flow_key][0]
+        heapq.heappush(self.flow_heap, (self.flow_rounds[flow_key], rank, job_id, flow_key))
+        # Устаревшие записи, застрявшие в глубине кучи, не копятся бесконечно
+        if len(self.flow_heap) > 2 * len(self.flows) + 64:
+            self.flow_heap = [
+                (self.flow_rounds[key], *self.flows[key][0], key) for key in self.flows
+            ]
+            heapq.heapify(self.flow_heap)
+
+    def _is_current(self, entry):
+        flow_round, rank, job_id, flow_key = entry
+        flow = self.flows.get(flow_key)
+        return bool(flow) and flow[0] == (rank, job_id) and self.flow_rounds[flow_key] == flow_round
+
+    def _top_flow(self):
+        """Актуальная вершина кучи потоков или None"""
+        while self.flow_heap and not self._is_current(self.flow_heap[0]):
+            heapq.heappop(self.flow_heap)
+        return self.flow_heap[0] if self.flow_heap else None
+
+    def _link_flow(self, job):
+        if job.flow_key not in self.flows:
+            # Новый поток встает в текущий круг, а не получает накопленный долг
+            top = self._top_flow()
+            self.flow_rounds[job.flow_key] = top[0] if top else 0
+            self.flows[job.flow_key] = []
+        flow = self.flows[job.flow_key]
+        entry = (job.rank(self.aging_factor), job.job_id)
+        bisect.insort(flow, entry)
+        if flow[0] == entry:
+            self._push_flow(job.flow_key)
+
+    def _unlink_flow(self, job):
+        flow = self.flows[job.flow_key]
+        index = bisect.bisect_left(flow, (job.rank(self.aging_factor), job.job_id))
+        del flow[index]
+        if not flow:
+            del self.flows[job.flow_key]
+            del self.flow_rounds[job.flow_key]
+        elif index == 0:
+            self._push_flow(job.flow_key)
+
+    def _next_job(self):
+        """Самое короткое с учетом ожидания задание среди потоков текущего круга.
+
+        Лимит выполняемых заданий на поток действует, только пока у других потоков есть что выполнять:
+        свободный обработчик не простаивает, если задания остались у одного пользователя.
+        Потоки, исчерпавшие лимит (их не больше числа обработчиков), временно вынимаются из кучи."""
+        capped = []
+        best = None
+        while True:
+            entry = self._top_flow()
+            if entry is None:
+                break
+            if self.running_per_flow.get(entry[3], 0) < self.max_running_per_flow:
+                best = self.jobs[entry[2]]
+                break
+            capped.append(heapq.heappop(self.flow_heap))
+        for entry in capped:
+            heapq.heappush(self.flow_heap, entry)
+        if best is None and capped:
+            best = self.jobs[capped[0][2]]
+        return best
+
+    async def get(self):
+        """Ждет и извлекает следующее задание"""
+        while True:
+            job = self._next_job()
+            if job is not None:
+                break
+            self.changed.clear()
+            await self.changed.wait()
+
+        self.flow_rounds[job.flow_key] += 1
+        self._unlink(job)
+        job.started_at = time.time()
+        if self.journal:
+            self.journal.add_attempt(job.job_id)
+        self.running[job.job_id] = job
+        self.running_per_flow[job.flow_key] = self.running_per_flow.get(job.flow_key, 0) + 1
+        return job
+
+    def close(self, job_id):
+        """Закрывает выполняемое задание для новых запросов и возвращает присоединенные к нему"""
+        job = self.running.get(job_id)
+        if not job:
+            return []
+        if self.by_key.get(job.key) is job:
+            del self.by_key[job.key]
+        followers, job.followers = job.followers, []
+        return followers
+
+    def done(self, job_id, keep_journal=False):
+        """Отмечает задание из get() выполненным и освобождает место обработчика.
+
+        keep_journal=True — задание прервано остановкой бота: строки остаются в журнале,
+        а попытка не засчитывается, чтобы при запуске задание выполнилось заново."""
+        job = self.running.pop(job_id, None)
+        if not job:
+            return
+        if self.journal:
+            if keep_journal:
+                self.journal.set_retries(job_id, job.retries)
+            else:
+                self.journal.remove_job(job_id)
+        if self.by_key.get(job.key) is job:
+            del self.by_key[job.key]
+        self.running_per_flow[job.flow_key] -= 1
+        if not self.running_per_flow[job.flow_key]:
+            del self.running_per_flow[job.flow_key]
+        self.changed.set()
+
+    def remove(self, job_id):
+        """Убирает ожидающее задание из очереди вместе с присоединенными запросами"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return False
+        self._unlink(job)
+        del self.by_key[job.key]
+        if self.journal:
+            self.journal.remove_job(job_id)
+        job.set_state(JOB_CANCELLED)
+        return True
+
+    def cancel(self, job_id, user_id):
+        """Отменяет запросы пользователя в задании и возвращает их.
+
+        Ожидающее задание без оставшихся запросов убирается из очереди, а выполняемое
+        прерывается через cancel_event; присоединенные запросы затем скачиваются сами."""
+        job = self.jobs.get(job_id) or self.running.get(job_id)
+        if not job or user_id not in job.user_ids():
+            return []
+
+        cancelled = [task for task in job.followers if task.user_id == user_id]
+        job.followers = [task for task in job.followers if task.user_id != user_id]
+        if job.user_id == user_id:
+            cancelled.insert(0, job.task)
+        if self.journal:
+            self.journal.remove_user(job_id, user_id)
+
+        if job_id in self.running:
+            if job.user_id == user_id:
+                job.cancel_event.set()
+                # Новые запросы того же видео не должны присоединяться к отмененному заданию
+                if self.by_key.get(job.key) is job:
+                    del self.by_key[job.key]
+            return cancelled
+
+        self._drop_user(job_id, user_id)
+        if job.user_id == user_id:
+            if job.followers:
+                # Задание переходит к первому присоединившемуся запросу
+                self._unlink_flow(job)
+                job.task = job.followers.pop(0)
+                job.user_id = job.task.user_id
+                job.flow_key = get_flow_key(job.task)
+                self._link_flow(job)
+            else:
+                self._unlink(job)
+                del self.by_key[job.key]
+                job.set_state(JOB_CANCELLED)
+        return cancelled
+
+    def _drop_user(self, job_id, user_id):
+        user_jobs = self.by_user[user_id]
+        del user_jobs[job_id]
+        if not user_jobs:
+            del self.by_user[user_id]
+
+    def _unlink(self, job):
+        del self.jobs[job.job_id]
+        self.pending_cost = self.pending_cost - job.cost if self.jobs else 0
+        for user_id in job.user_ids():
+            if job.job_id in self.by_user.get(user_id, ()):
+                self._drop_user(job.job_id, user_id)
+        self._unlink_flow(job)
+
+    def dispatch_order(self):
+        """Ожидаемый порядок выдачи заданий, если новых не поступит (без учета лимита на поток).
+
+        i-е задание потока выдается в круге flow_round + i, поэтому порядок — сортировка
+        по (круг выдачи, rank, job_id)."""
+        order = sorted(
+            (self.flow_rounds[flow_key] + index, rank, job_id)
+            for flow_key, flow in self.flows.items()
+            for index, (rank, job_id) in enumerate(flow)
+        )
+        return [job_id for dispatch_round, rank, job_id in order]
+
+    def position(self, job_id):
+        """Позиция ожидающего задания в dispatch_order() (начиная с 1) или 0, если его нет в очереди.
+
+        Считается без сортировки: по каждому потоку — сколько его заданий выдается раньше (O(потоков))."""
+        job = self.jobs.get(job_id)
+        if not job:
+            return 0
+        entry = (job.rank(self.aging_factor), job_id)
+        dispatch_round = self.flow_rounds[job.flow_key] + bisect.bisect_left(self.flows[job.flow_key], entry)
+        position = 1
+        for flow_key, flow in self.flows.items():
+            # Задания потока до этого индекса выдаются в более ранних кругах
+            earlier = dispatch_round - self.flow_rounds[flow_key]
+            if earlier >= len(flow):
+                position += len(flow)
+            elif earlier >= 0:
+                position += earlier + (flow[earlier] < entry)
+        return position
+
+    def predicted_wait(self):
+        """Прогноз ожидания нового задания: оставшаяся работа, поделенная между обработчиками"""
+        if len(self.running) < self.workers and not self.jobs:
+            return 0
+        now = time.time()
+        backlog = sum(max(job.cost - (now - job.started_at), 0) for job in self.running.values())
+        return (backlog + self.pending_cost) / self.workers
+
+    def get_admission_stats(self):
+        shed_total = sum(self.shed.values())
+        requests_total = self.admitted + shed_total
+        return {
+            'admitted': self.admitted,
+            'shed': shed_total,
+            'shed_rate': shed_total * 100 / requests_total if requests_total else 0,
+            **{f"shed:{reason}": count for reason, count in self.shed.items()},
         }
-        save_user_data()
-    # Добавляем проверку для существующих пользователей
-    elif 'download_count' not in user_data[str(user_id)]:
-        user_data[str(user_id)]['download_count'] = 0
-        save_user_data()
-
-# Функция для обновления позиций в очереди
-def update_queue_positions():
-    """Обновляет позиции в очереди для всех пользователей"""
-    global queue_status
-
-    # Создаем временную очередь для анализа
-    temp_queue = []
-    while not download_queue.empty():
+
+    def estimate_finish_times(self, order=None):
+        """Прогноз, через сколько секунд завершится каждое задание: {job_id: секунды}.
+
+        order — уже посчитанный dispatch_order(), чтобы не считать его повторно."""
+        if order is None:
+            order = self.dispatch_order()
+        now = time.time()
+        finish_times = {}
+        # Моменты, когда освободятся обработчики
+        free_at = []
+        for job in self.running.values():
+            remaining = max(job.cost - (now - job.started_at), 0)
+            finish_times[job.job_id] = remaining
+            free_at.append(remaining)
+        free_at.extend([0] * max(self.workers - len(free_at), 0))
+        heapq.heapify(free_at)
+
+        for job_id in order:
+            finish = heapq.heappop(free_at) + self.jobs[job_id].cost
+            finish_times[job_id] = finish
+            heapq.heappush(free_at, finish)
+        return finish_times
+
+    def peek(self):
+        """Возвращает следующее задание, не извлекая его"""
+        return self._next_job()
+
+    @staticmethod
+    def positions(order):
+        """Позиции ожидающих заданий (начиная с 1) по dispatch_order(): {job_id: позиция}"""
+        return {job_id: position for position, job_id in enumerate(order, 1)}
+
+    def jobs_for_user(self, user_id):
+        """Возвращает ожидающие задания пользователя в порядке добавления"""
+        return [self.jobs[job_id] for job_id in self.by_user.get(user_id, ())]
+
+    def running_for_user(self, user_id):
+        return [job for job in self.running.values() if user_id in job.user_ids()]
+
+    def qsize(self):
+        return len(self.jobs)
+
+    def empty(self):
+        return not self.jobs
+
+download_queue = DownloadQueue(
+    DOWNLOAD_WORKERS, MAX_RUNNING_PER_USER, MAX_OUTSTANDING_PER_USER, MAX_QUEUE_SIZE, MAX_QUEUE_WAIT,
+    job_cost_model, SCHEDULER_AGING_FACTOR
+)
+
+# Лимиты очереди, которые администратор может менять командой /limits: имя -> (атрибут, описание)
+QUEUE_LIMITS = {
+    'queue_size': ('max_size', "Максимум заданий в очереди (0 — без ограничения)"),
+    'wait': ('max_wait', "Максимальное прогнозируемое ожидание, сек (0 — без ограничения)"),
+    'per_user': ('max_outstanding_per_user', "Незавершенных заданий на пользователя"),
+    'running_per_user': ('max_running_per_flow', "Одновременных загрузок на пользователя или чат"),
+}
+
+def load_download_queue():
+    """Открывает журнал заданий очереди"""
+    try:
+        download_queue.attach_journal(JobJournal(QUEUE_DB_FILE))
+    except Exception as e:
+        logger.error(f"Ошибка при открытии журнала очереди: {e}")
+        logger.error(traceback.format_exc())
+
+def restore_task_message(app, chat_id, message_id):
+    """Восстанавливает статусное сообщение задания по chat_id и message_id для редактирования"""
+    if chat_id is None or message_id is None:
+        return None
+    chat = Chat(id=chat_id, type=Chat.PRIVATE if chat_id > 0 else Chat.GROUP)
+    message = Message(message_id=message_id, date=datetime.now(), chat=chat)
+    message.set_bot(app.bot)
+    return message
+
+async def restore_download_queue(app):
+    """Возвращает в очередь задания из журнала, не завершенные до перезапуска"""
+    if not download_queue.journal:
+        return
+    restored = 0
+    for row in download_queue.journal.all_rows():
+        row_id, user_id, chat_id, message_id, url, format_type, format_id, url_type, is_inline, retries = row
         try:
-            task = download_queue.get_nowait()
-            temp_queue.append(task)
-            download_queue.task_done()
-        except:
-            break
+            message = restore_task_message(app, chat_id, message_id)
+            task = DownloadTask(user_id, url, format_type, format_id, url_type, message, bool(is_inline))
+            if retries >= MAX_JOB_RETRIES:
+                # Задание, которое несколько раз прерывалось падением бота, больше не запускается
+                logger.warning(f"Задание {task!r} отброшено после {retries} попыток")
+                download_queue.journal.remove_row(row_id)
+                await safe_edit_task_message(
+                    app, task, "❌ Не удалось обработать запрос. Пожалуйста, попробуйте позже.", retry=False
+                )
+                continue
+            # Задание записывается в журнал заново под новым номером, старая строка удаляется
+            job = download_queue.put(task, admission=False)
+            job.retries = max(job.retries, retries)
+            download_queue.journal.set_retries(job.job_id, job.retries)
+            download_queue.journal.remove_row(row_id)
+            restored += 1
+            await safe_edit_task_message(app, task, "🔄 Бот был перезапущен, ваш запрос снова в очереди.", retry=False)
+        except Exception as e:
+            logger.error(f"Не удалось восстановить задание {row_id} из журнала: {e}")
+    if restored:
+        logger.info(f"Восстановлено заданий из журнала очереди: {restored}")
+
+def get_cancel_keyboard(job_id):
+    """Клавиатура с кнопкой отмены задания"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_dl:{job_id}")]])
+
+async def enqueue_download(task, reply, queued_text):
+    """Ставит задание в очередь и сообщает пользователю позицию или причину отказа"""
+    try:
+        job = download_queue.put(task)
+    except QueueFullError:
+        await reply(
+            f"❌ У вас уже {download_queue.max_outstanding_per_user} незавершенных заданий.\n\n"
+            "Дождитесь их завершения или отмените лишние командой /cancel."
+        )
+        return None
+    except QueueBusyError as e:
+        logger.warning(f"Задание отклонено, очередь перегружена: {e}")
+        await reply("⏳ Бот сейчас перегружен. Пожалуйста, попробуйте позже.")
+        return None
 
-    # Восстанавливаем очередь и обновляем позиции
-    for i, task in enumerate(temp_queue):
-        user_id, url, format_type, format_id, url_type, message, is_inline = task
-        queue_status[user_id] = i + 1  # Позиция в очереди (начиная с 1)
-        asyncio.create_task(download_queue.put(task))
+    reply_markup = get_cancel_keyboard(job.job_id)
+    position = download_queue.position(job.job_id)
+    if position > 0:
+        await reply(f"{queued_text} Позиция: {position}", reply_markup=reply_markup)
+    elif job.task is not task:
+        await reply(
+            "⏳ Это видео уже загружается по другому запросу. Файл придет, как только загрузка завершится.",
+            reply_markup=reply_markup
+        )
+    else:
+        await reply(queued_text, reply_markup=reply_markup)
+    return job.job_id
+
+async def cancel_user_jobs(app, user_id, job_ids):
+    """Отменяет запросы пользователя в указанных заданиях и возвращает число отмененных заданий"""
+    cancelled_jobs = 0
+    for job_id in job_ids:
+        cancelled_tasks = download_queue.cancel(job_id, user_id)
+        if cancelled_tasks:
+            cancelled_jobs += 1
+        for task in cancelled_tasks:
+            await safe_edit_task_message(app, task, "❌ Загрузка отменена.", retry=False)
+    return cancelled_jobs
 
 async def monitor_download_size(file_path, message, max_size=50*1024*1024):  # 50 МБ
     """Мониторит размер файла во время загрузки и прерывает, если превышен лимит"""
@@ -1285,165 +3558,89 @@ async def monitor_download_size(file_path, message, max_size=50*1024*1024):  # 5
 
     return True
 
-async def process_download_queue(app):
-    """Обрабатывает очередь загрузок"""
-    global queue_processing
-    queue_processing = True
-
-    while not download_queue.empty():
-        # Получаем задание из очереди
-        task = await download_queue.get()
-        user_id, url, format_type, format_id, url_type, message, is_inline = task
-
-        try:
-            # Обновляем статус для всех пользователей
-            update_queue_positions()
-
-            # Функция для безопасного редактирования сообщения
-            async def safe_edit_message(text, retry=True):
-                try:
-                    if message and hasattr(message, 'edit_text'):
-                        await message.edit_text(text)
-                    else:
-                        # Если сообщение недоступно, отправляем новое
-                        new_message = await app.bot.send_message(chat_id=user_id, text=text)
-                        return new_message
-                except Exception as e:
-                    logger.warning(f"Не удалось отредактировать сообщение: {e}")
-                    if retry:
-                        # Пытаемся отправить новое сообщение
-                        try:
-                            new_message = await app.bot.send_message(chat_id=user_id, text=text)
-                            return new_message
-                        except Exception as send_error:
-                            logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {send_error}")
-                    return None
-
-
-            async def safe_send_file(file_path, title, is_audio, source_text, is_inline_mode=False):
-                """Безопасная отправка файла с учетом режима (инлайн или обычный)"""
-                try:
-                    with open(file_path, 'rb') as file:
-
-                        if is_inline_mode:
-
-                            target_chat_id = user_id
-                        else:
-                            if message and hasattr(message, 'chat_id'):
-                                target_chat_id = message.chat_id
-                            else:
-                                target_chat_id = user_id
-
-                        if is_audio:
-                            return await asyncio.wait_for(
-                                app.bot.send_audio(
-                                    chat_id=target_chat_id,
-                                    audio=file,
-                                    caption=f"🎵 {title}",
-                                    title=title[:30] + "..." if len(title) > 30 else title,
-                                    performer=source_text
-                                ),
-                                timeout=SEND_FILE_TIMEOUT
-                            )
-                        else:
-                            return await asyncio.wait_for(
-                                app.bot.send_video(
-                                    chat_id=target_chat_id,
-                                    video=file,
-                                    caption=f"🎥 {title}\n📺 Источник: {source_text}",
-                                    supports_streaming=True
-                                ),
-                                timeout=SEND_FILE_TIMEOUT
-                            )
-                except asyncio.TimeoutError:
-                    raise
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке файла: {e}")
-                    raise
-
-
-            # Уведомляем пользователя о начале обработки
-            await safe_edit_message("⏳ Начинаю загрузку...")
-
-            # Выполняем загрузку асинхронно
+async def safe_edit_task_message(app, task, text, retry=True, reply_markup=None):
+    """Безопасно обновляет статусное сообщение задания или отправляет новое"""
+    user_id, message = task.user_id, task.message
+    try:
+        if message and hasattr(message, 'edit_text'):
+            await message.edit_text(text, reply_markup=reply_markup)
+        else:
+            # Если сообщение недоступно, отправляем новое
+            new_message = await app.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+            return new_message
+    except Exception as e:
+        logger.warning(f"Не удалось отредактировать сообщение: {e}")
+        if retry:
+            # Пытаемся отправить новое сообщение
             try:
-                if format_type == "tiktok" or url_type == "tiktok":
-                    filename, title = await download_video_async(url, "best", None, url_type, message)
-                elif format_type == "best":
-                    filename, title = await download_video_async(url, "best", None, url_type, message)
-                elif format_type == "max":
-                    filename, title = await download_video_async(url, "max", None, url_type, message)
-                elif format_type == "audio":
-                    filename, title = await download_audio_async(url, url_type, message)
-                else:
-                    filename, title = await download_video_async(url, format_type, format_id, url_type, message)
-            except Exception as e:
-                if "Файл слишком большой" in str(e):
-                    error_text = (
-                        f"❌ Файл слишком большой для Telegram (превышает 50 МБ).\n\n"
-                        "Попробуйте выбрать другое качество."
-                    )
-                else:
-                    error_text = "❌ Произошла ошибка при загрузке видео. Пожалуйста, попробуйте позже."
+                new_message = await app.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+                return new_message
+            except Exception as send_error:
+                logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {send_error}")
+        return None
 
-                await safe_edit_message(error_text)
-                continue
+async def process_download_task(app, task, work_dir, job=None):
+    """Выполняет запрос из очереди: загрузка, отправка и кэширование.
 
-            file_size = os.path.getsize(filename)
+    job передается для запроса владельца задания: его состояние, счетчики и отмена.
+    Возвращает текст ошибки, если видео не удалось скачать, иначе None."""
+    user_id, url, url_type, message = task.user_id, task.url, task.url_type, task.message
+    format_type, format_id, is_inline = task.format_type, task.format_id, task.is_inline
+    cancel_event = job.cancel_event if job else None
+    reply_markup = get_cancel_keyboard(job.job_id) if job else None
 
-            if file_size > 50 * 1024 * 1024:
-                os.remove(filename)
-                await safe_edit_message(
-                    f"❌ Файл слишком большой для Telegram ({file_size//1024//1024} МБ).\n\n"
-                    "Попробуйте выбрать другое качество."
-                )
-                continue
+    def set_state(state):
+        if job:
+            job.set_state(state)
 
-            is_audio = filename.endswith(('.mp3', '.m4a', '.ogg', '.wav'))
+    def cancelled():
+        """Проверяет отмену; сообщение об отмене уже показано командой /cancel"""
+        if cancel_event and cancel_event.is_set():
+            logger.info(f"Загрузка {url} отменена пользователем {user_id}")
+            set_state(JOB_CANCELLED)
+            return True
+        return False
 
-            if url_type == "youtube_music":
-                source_text = "YouTube Music"
-            elif url_type == "tiktok":
-                source_text = "TikTok"
-            else:
-                source_text = "YouTube"
+    try:
+        # Функция для безопасного редактирования сообщения
+        async def safe_edit_message(text, retry=True, reply_markup=None):
+            return await safe_edit_task_message(app, task, text, retry, reply_markup)
+
+        # В инлайн-режиме файл отправляется пользователю в личный чат
+        if is_inline or not (message and hasattr(message, 'chat_id')):
+            target_chat_id = user_id
+        else:
+            target_chat_id = message.chat_id
 
-            await safe_edit_message("📤 Отправляю файл...")
+        if url_type == "youtube_music":
+            source_text = "YouTube Music"
+        elif url_type == "tiktok":
+            source_text = "TikTok"
+        else:
+            source_text = "YouTube"
 
+        async def safe_send_file(file_path, title, is_audio, source_text):
+            """Безопасная отправка файла с учетом режима (инлайн или обычный)"""
             try:
-                await safe_send_file(filename, title, is_audio, source_text, is_inline)
+                with open(file_path, 'rb') as file:
+                    if is_audio:
+                        caption = f"🎵 {title}"
+                    else:
+                        caption = f"🎥 {title}\n📺 Источник: {source_text}"
+                    return await send_media(
+                        app.bot, target_chat_id, file, 'audio' if is_audio else 'video', caption, title, source_text
+                    )
             except asyncio.TimeoutError:
-                await safe_edit_message("❌ Таймаут при отправке файла. Пожалуйста, попробуйте позже.")
-                continue
+                raise
             except Exception as e:
                 logger.error(f"Ошибка при отправке файла: {e}")
-                await safe_edit_message("❌ Ошибка при отправке файла. Пожалуйста, попробуйте позже.")
-                continue
-
-            # Добавляем в кэш (только для видео)
-            if not is_audio:
-                # Получаем информацию о формате для качества
-                quality = "best"
-                if format_type != "best" and format_type != "tiktok" and format_type != "max":
-                    # Находим информацию о формате
-                    if user_id in user_videos and 'formats' in user_videos[user_id]:
-                        for fmt in user_videos[user_id]['formats']:
-                            if fmt.get('format_id') == format_id:
-                                quality = f"{fmt.get('height', 'unknown')}p"
-                                break
-
-                add_to_video_cache(url, filename, format_id, quality,
-                                  user_videos[user_id].get('duration', 0) if user_id in user_videos else 0,
-                                  title, url_type)
-            else:
-                os.remove(filename)  # Аудио не кэшируем
+                raise
 
+        async def finish_task():
+            """Завершает успешно выполненное задание"""
+            set_state(JOB_DONE)
             # Увеличиваем счетчик загрузок пользователя
-            if str(user_id) in user_data:
-                if 'download_count' not in user_data[str(user_id)]:
-                    user_data[str(user_id)]['download_count'] = 0
-                user_data[str(user_id)]['download_count'] += 1
-                save_user_data()
+            user_store.increment_downloads(user_id)
 
             if is_inline:
                 if message and hasattr(message, 'delete'):
@@ -1454,34 +3651,217 @@ async def process_download_queue(app):
             else:
                 await safe_edit_message("✅ Готово! Что-нибудь еще?")
 
-            if user_id in user_videos:
-                del user_videos[user_id]
+        # Если этот формат уже отправлялся, пересылаем его по file_id без загрузки
+        format_key = get_task_format_key(task)
+        cache_data = get_task_cache_entry(task)
+        if cache_data:
+            if cancelled():
+                return None
+            set_state(JOB_UPLOADING)
+            await safe_edit_message("📤 Отправляю файл из кэша...")
+            title = cache_data.get('title') or 'Video'
+            if format_key == 'audio':
+                caption = f"🎵 {title}"
+            else:
+                caption = f"🎥 {title}\n📺 Источник: {source_text}"
+            try:
+                sent_message = await send_cached_media(app.bot, target_chat_id, cache_data, caption, source_text)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить файл из кэша, скачиваем заново: {e}")
+                sent_message = None
+
+            if sent_message:
+                if not cancelled():
+                    await finish_task()
+                return
+
+        # Уведомляем пользователя о начале обработки
+        set_state(JOB_EXTRACTING)
+        await safe_edit_message("⏳ Начинаю загрузку...", reply_markup=reply_markup)
 
-            # Удаляем пользователя из очереди
-            if user_id in queue_status:
-                del queue_status[user_id]
+        # Информация, извлеченная при выборе качества, используется повторно
+        info = get_cached_video_info(url)
 
+        # Выполняем загрузку асинхронно
+        download_started = time.time()
+        try:
+            if format_type == "tiktok" or url_type == "tiktok":
+                filename, info = await download_video_async(url, "best", None, url_type, message, info, work_dir, job, reply_markup)
+            elif format_type == "best":
+                filename, info = await download_video_async(url, "best", None, url_type, message, info, work_dir, job, reply_markup)
+            elif format_type == "max":
+                filename, info = await download_video_async(url, "max", None, url_type, message, info, work_dir, job, reply_markup)
+            elif format_type == "audio":
+                filename, info = await download_audio_async(url, url_type, message, info, work_dir, job, reply_markup)
+            else:
+                filename, info = await download_video_async(url, format_type, format_id, url_type, message, info, work_dir, job, reply_markup)
         except Exception as e:
-            logger.error(f"Ошибка при обработке задания из очереди: {e}")
-            logger.error(traceback.format_exc())
-            try:
-                await safe_edit_message("❌ Произошла ошибка при загрузке видео. Пожалуйста, попробуйте позже.")
-            except:
-                pass
+            if cancelled():
+                # Частичные файлы удалит обработчик очереди
+                return None
+            set_state(JOB_FAILED)
+            if "Файл слишком большой" in str(e):
+                error_text = (
+                    f"❌ Файл слишком большой для Telegram (превышает 50 МБ).\n\n"
+                    "Попробуйте выбрать другое качество."
+                )
+            else:
+                error_text = "❌ Произошла ошибка при загрузке видео. Пожалуйста, попробуйте позже."
 
-            # Отправляем сообщение об ошибке администратору
-            try:
-                if ADMIN_ID:
-                    error_text = f"❌ Ошибка при обработке задания из очереди:\n\n{str(e)[:1000]}"
-                    await app.bot.send_message(chat_id=ADMIN_ID, text=error_text)
-            except Exception as admin_error:
-                logger.error(f"Ошибка при отправке сообщения администратору: {admin_error}")
+            await safe_edit_message(error_text)
+            return error_text
+
+        file_size = os.path.getsize(filename)
+
+        # Отмена могла прийти, когда загрузка уже завершилась
+        if cancelled():
+            os.remove(filename)
+            return None
+
+        if file_size > 50 * 1024 * 1024:
+            os.remove(filename)
+            set_state(JOB_FAILED)
+            error_text = (
+                f"❌ Файл слишком большой для Telegram ({file_size//1024//1024} МБ).\n\n"
+                "Попробуйте выбрать другое качество."
+            )
+            await safe_edit_message(error_text)
+            return error_text
 
-        # Обновляем позиции в очереди после завершения задания
-        update_queue_positions()
-        await asyncio.sleep(1)  # Небольшая пауза между заданиями
+        is_audio = filename.endswith(AUDIO_EXTENSIONS)
+        title = info.get('title') or ('audio' if is_audio else 'video')
 
-    queue_processing = False
+        # Качество и длительность — из информации, по которой шла загрузка
+        quality = "audio" if is_audio else "best"
+        if format_type not in ("best", "tiktok", "max", "audio"):
+            for fmt in info.get('formats') or []:
+                if fmt.get('format_id') == format_id:
+                    quality = f"{fmt.get('height', 'unknown')}p"
+                    break
+        duration = info.get('duration') or 0
+
+        set_state(JOB_UPLOADING)
+        await safe_edit_message("📤 Отправляю файл...")
+
+        upload_started = time.time()
+        try:
+            sent_message = await safe_send_file(filename, title, is_audio, source_text)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке файла: {e}")
+            # Скачанный файл остается в кэше: присоединенные запросы получат его без повторной загрузки
+            add_to_video_cache(url, filename, format_id, quality, duration, title, url_type, format_key)
+            if cancelled():
+                return None
+            set_state(JOB_FAILED)
+            if isinstance(e, asyncio.TimeoutError):
+                await safe_edit_message("❌ Таймаут при отправке файла. Пожалуйста, попробуйте позже.")
+            else:
+                await safe_edit_message("❌ Ошибка при отправке файла. Пожалуйста, попробуйте позже.")
+            return
+        if job:
+            job.uploaded_bytes = file_size
+
+        # Фактические скорости уточняют прогноз длительности следующих заданий
+        job_cost_model.observe(url_type, file_size, upload_started - download_started, time.time() - upload_started)
+
+        # Добавляем в кэш (только для видео)
+        if not is_audio:
+            add_to_video_cache(url, filename, format_id, quality, duration, title, url_type, format_key)
+        else:
+            os.remove(filename)  # Аудио не храним на диске, достаточно file_id
+
+        # Запоминаем file_id, чтобы повторные запросы отправлялись без загрузки
+        register_sent_file(url, format_key, sent_message, title, url_type, duration, quality, format_id)
+
+        # Отмена во время отправки: файл уже ушел, но сообщение об отмене не перезаписываем
+        if not cancelled():
+            await finish_task()
+
+    except Exception as e:
+        logger.error(f"Ошибка при обработке задания из очереди: {e}")
+        logger.error(traceback.format_exc())
+        set_state(JOB_FAILED)
+        try:
+            await safe_edit_message("❌ Произошла ошибка при загрузке видео. Пожалуйста, попробуйте позже.")
+        except:
+            pass
+
+        # Отправляем сообщение об ошибке администратору
+        try:
+            if ADMIN_ID:
+                error_text = f"❌ Ошибка при обработке задания из очереди:\n\n{str(e)[:1000]}"
+                await app.bot.send_message(chat_id=ADMIN_ID, text=error_text)
+        except Exception as admin_error:
+            logger.error(f"Ошибка при отправке сообщения администратору: {admin_error}")
+
+async def requeue_follower(app, task):
+    """Ставит присоединенный запрос в очередь отдельным заданием (без проверки лимитов)"""
+    job = download_queue.put(task, admission=False)
+    await safe_edit_task_message(
+        app, task, "⏳ Загрузка по другому запросу не завершилась, ваш запрос снова в очереди.",
+        reply_markup=get_cancel_keyboard(job.job_id)
+    )
+
+def clear_work_dir(work_dir):
+    """Удаляет из рабочей директории обработчика файлы, оставшиеся от прерванной загрузки"""
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        try:
+            if os.path.isfile(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить временный файл {path}: {e}")
+
+async def download_worker(app, worker_id):
+    """Долгоживущий обработчик очереди загрузок со своей рабочей директорией"""
+    work_dir = os.path.join(DOWNLOAD_DIR, f"worker_{worker_id}")
+    os.makedirs(work_dir, exist_ok=True)
+    clear_work_dir(work_dir)
+
+    while True:
+        job = await download_queue.get()
+        stopped = False
+        try:
+            error_text = await process_download_task(app, job.task, work_dir, job)
+            logger.info(
+                f"Задание #{job.job_id} ({job.state}) выполнено за {time.time() - job.started_at:.1f} сек, "
+                f"прогноз {job.cost:.1f} сек"
+            )
+            # Запросы того же видео, присоединенные к заданию, получают файл по file_id без повторной загрузки
+            for task in download_queue.close(job.job_id):
+                if error_text:
+                    await safe_edit_task_message(app, task, error_text)
+                elif get_task_cache_entry(task):
+                    await process_download_task(app, task, work_dir)
+                else:
+                    # Задание отменено или не завершилось: запрос скачивается отдельным заданием через очередь
+                    await requeue_follower(app, task)
+        except asyncio.CancelledError:
+            # Остановка бота: задание остается в журнале и повторится после запуска
+            stopped = True
+            raise
+        finally:
+            download_queue.done(job.job_id, keep_journal=stopped)
+            clear_work_dir(work_dir)
+
+def start_download_worker(app, worker_id):
+    """Запускает обработчик и перезапускает его, если он завершился с ошибкой"""
+    def on_done(worker_task):
+        if worker_task.cancelled():
+            return
+        logger.error(f"Обработчик загрузок {worker_id} завершился: {worker_task.exception()}")
+        start_download_worker(app, worker_id)
+
+    worker_task = asyncio.create_task(download_worker(app, worker_id))
+    worker_task.add_done_callback(on_done)
+    download_workers[worker_id] = worker_task
+
+async def start_download_workers(app):
+    """Восстанавливает задания из журнала и запускает DOWNLOAD_WORKERS обработчиков очереди при старте бота"""
+    await restore_download_queue(app)
+    for worker_id in range(DOWNLOAD_WORKERS):
+        start_download_worker(app, worker_id)
+    logger.info(f"Запущено обработчиков загрузок: {DOWNLOAD_WORKERS}")
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1537,7 +3917,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "2. 🎵 Для скачивания только аудио используйте команду /audio [ссылка]\n"
             "3. 🔍 Для поиска музыки используйте команду /search [запрос]\n"
             "4. ⚙️ Бот автоматически предложит выбрать качество видео\n"
-            "5. 📦 Часто запрашиваемые видео сохраняются в кэше для быстрого доступа\n\n"
+            "5. 📦 Часто запрашиваемые видео сохраняются в кэше для быстрого доступа\n"
+            "6. ❌ Для отмены загрузок используйте команду /cancel или кнопку «Отменить»\n\n"
             "📝 Примеры ссылок:\n"
             "• YouTube: https://www.youtube.com/watch?v=VIDEO_ID\n"
             "• YouTube Music: https://music.youtube.com/watch?v=VIDEO_ID\n"
@@ -1553,7 +3934,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "2. 🎵 Для скачивания только аудио используйте команду /audio [ссылка]\n"
             "3. 🔍 Для поиска музыки используйте команду /search [запрос]\n"
             "4. ⚙️ Бот автоматически предложит выбрать качество видео\n"
-            "5. 📦 Часто запрашиваемые видео сохраняются в кэше для быстрого доступа\n\n"
+            "5. 📦 Часто запрашиваемые видео сохраняются в кэше для быстрого доступа\n"
+            "6. ❌ Для отмены загрузок используйте команду /cancel или кнопку «Отменить»\n\n"
             "📝 Примеры ссылок:\n"
             "• YouTube: https://www.youtube.com/watch?v=VIDEO_ID\n"
             "• YouTube Music: https://music.youtube.com/watch?v=VIDEO_ID\n"
@@ -1573,23 +3955,102 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
         return
 
-    # Получаем размер кэша
-    cache_size = 0
-    if os.path.exists(CACHE_DIR):
-        for path, dirs, files in os.walk(CACHE_DIR):
-            for f in files:
-                fp = os.path.join(path, f)
-                cache_size += os.path.getsize(fp)
+    # Счетчики кэша ведутся инкрементально, обход CACHE_DIR не нужен
+    cache_stats = video_cache_store.get_stats()
+    info_stats = video_info_cache.get_stats()
+    admission_stats = download_queue.get_admission_stats()
+    ydl_stats = ydl_pool.get_stats()
+    poller_stats = subscription_poller.get_stats()
+    feed_stats = feed_client.get_stats()
+    next_check_text = format_eta(poller_stats['next_in']) if poller_stats['next_in'] is not None else "—"
+    intervals_text = (
+        f"{format_eta(poller_stats['min_interval'])}–{format_eta(poller_stats['max_interval'])}"
+        if poller_stats['min_interval'] is not None else "—"
+    )
+    executors_text = "\n".join(
+        f"  {name}: {stats['running']}/{stats['workers']} в работе, ожидают {stats['pending']}/{stats['max_pending']} "
+        f"(загрузка {stats['saturation']:.0f}%, пик {stats['peak']}), отклонено {stats['rejected']}, "
+        f"таймаутов {stats['timeouts']}"
+        for name, stats in ((name, executor.get_stats()) for name, executor in executors.items())
+    )
+    top_text = ", ".join(
+        f"{'@' + username if username else user_id_str} ({count})"
+        for user_id_str, username, count in user_store.top_downloaders(TOP_DOWNLOADERS_LIMIT)
+    )
+    requests_total = cache_stats.get('hits', 0) + cache_stats.get('misses', 0)
+    hit_rate = cache_stats.get('hits', 0) * 100 / requests_total if requests_total else 0
+    bytes_by_type = ", ".join(
+        f"{name[len('bytes:'):]}: {value//1024//1024} МБ"
+        for name, value in sorted(cache_stats.items()) if name.startswith('bytes:') and value
+    )
 
     stats_text = (
         f"📊 Статистика бота:\n\n"
-        f"• Пользователей: {len(user_data)}\n"
-        f"• Видео в кэше: {len(load_video_cache())}\n"
-        f"• Размер кэша: {cache_size//1024//1024} МБ\n"
-        f"• Заданий в очереди: {download_queue.qsize()}"
+        f"• Пользователей: {user_store.count()}\n"
+        f"• Активных за {ACTIVE_USER_DAYS} дн.: {user_store.count_active(ACTIVE_USER_DAYS)}\n"
+        f"• Топ по загрузкам: {top_text or 'нет данных'}\n"
+        f"• Видео в кэше: {cache_stats.get('entries', 0)}\n"
+        f"• Размер кэша: {cache_stats.get('total_bytes', 0)//1024//1024} МБ\n"
+        f"• По источникам: {bytes_by_type or 'нет данных'}\n"
+        f"• Ссылок найдено в кэше: {cache_stats.get('hits', 0)}, не найдено: {cache_stats.get('misses', 0)} ({hit_rate:.0f}%)\n"
+        f"• Кэш метаданных: {info_stats['entries']} записей ({info_stats['bytes']//1024//1024} МБ), попаданий {info_stats['hits']}, "
+        f"промахов {info_stats['misses']}, объединено {info_stats['coalesced']}, ошибок из кэша {info_stats['negative_hits']}\n"
+        f"• Заданий в очереди: {download_queue.qsize()}\n"
+        f"• Допуск в очередь: принято {admission_stats['admitted']}, отклонено {admission_stats['shed']} "
+        f"({admission_stats['shed_rate']:.1f}%: лимит пользователя {admission_stats['shed:user_limit']}, "
+        f"переполнение {admission_stats['shed:capacity']}, долгое ожидание {admission_stats['shed:deadline']})\n"
+        f"• Ограничение частоты: ожиданий {rate_limiter.throttled}, ответов HTTP 429 {rate_limiter.rate_limited}\n"
+        f"• Экземпляры yt-dlp: создано {ydl_stats['created']}, повторно использовано {ydl_stats['reused']}, "
+        f"пересоздано {ydl_stats['recycled']}, открыто {ydl_stats['open']}\n"
+        f"• Подписки: {poller_stats['subscriptions']} на {poller_stats['channels']} каналов, "
+        f"загрузок каналов {poller_stats['fetches']}, уведомлений {poller_stats['notifications']}\n"
+        f"• Расписание подписок: ближайшая проверка через {next_check_text}, интервалы {intervals_text}, "
+        f"ожиданий бюджета {poller_stats['budget_waits']}\n"
+        f"• Ленты каналов: запросов {feed_stats['requests']}, без изменений (304) {feed_stats['not_modified']}, "
+        f"ошибок {feed_stats['failures']}, через yt-dlp {poller_stats['fallbacks']}\n"
+        f"• Пулы потоков:\n{executors_text}"
     )
     await update.message.reply_text(stats_text)
 
+# Команда /limits
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /limits: просмотр и изменение лимитов очереди (только для админа)"""
+    user_id = update.effective_user.id
+    if str(user_id) != str(ADMIN_ID):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    if context.args:
+        if len(context.args) != 2 or context.args[0] not in QUEUE_LIMITS:
+            await update.message.reply_text(
+                f"❌ Использование: /limits <{'|'.join(QUEUE_LIMITS)}> <значение>"
+            )
+            return
+        try:
+            value = int(context.args[1])
+            if value < 0:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❌ Значение должно быть неотрицательным целым числом.")
+            return
+
+        attr = QUEUE_LIMITS[context.args[0]][0]
+        setattr(download_queue, attr, value)
+        # Новый лимит одновременных загрузок может разблокировать ожидающие задания
+        download_queue.changed.set()
+        logger.info(f"Лимит очереди {context.args[0]} изменен на {value}")
+
+    admission_stats = download_queue.get_admission_stats()
+    lines = ["⚙️ Лимиты очереди:\n"]
+    for name, (attr, description) in QUEUE_LIMITS.items():
+        lines.append(f"• {name} = {getattr(download_queue, attr)} — {description}")
+    lines.append(
+        f"\n📊 Прогноз ожидания: {format_eta(download_queue.predicted_wait())}, "
+        f"отклонено {admission_stats['shed']} из {admission_stats['admitted'] + admission_stats['shed']} "
+        f"({admission_stats['shed_rate']:.1f}%)"
+    )
+    await update.message.reply_text("\n".join(lines))
+
 # Команда /broadcast
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /broadcast (только для админа)"""
@@ -1606,7 +4067,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     success_count = 0
     fail_count = 0
 
-    for user_id_str in user_data.keys():
+    for user_id_str in user_store.iter_user_ids():
         try:
             await context.bot.send_message(chat_id=user_id_str, text=f"📢 Рассылка:\n\n{message}")
             success_count += 1
@@ -1655,22 +4116,8 @@ async def audio_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Добавляем задание в очередь
-    task = (user_id, url, "audio", None, url_type, update.message, False)
-    await download_queue.put(task)
-
-    # Обновляем позиции в очереди
-    update_queue_positions()
-
-    # Сообщаем пользователю о позиции в очереди
-    position = queue_status.get(user_id, 0)
-    if position > 0:
-        await update.message.reply_text(f"📋 Ваш запрос на аудио добавлен в очередь. Позиция: {position}")
-    else:
-        await update.message.reply_text("📋 Ваш запрос на аудио добавлен в очередь.")
-
-    # Запускаем обработку очереди, если она не активна
-    if not queue_processing:
-        asyncio.create_task(process_download_queue(context.application))
+    task = DownloadTask(user_id, url, "audio", None, url_type, update.message, False)
+    await enqueue_download(task, update.message.reply_text, "📋 Ваш запрос на аудио добавлен в очередь.")
 # Команда /search - начало поиска
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /search - начало процесса поиска"""
@@ -1735,16 +4182,14 @@ async def execute_search(update: Update, context: ContextTypes.DEFAULT_TYPE, que
         )
 
     try:
-        loop = asyncio.get_event_loop()
-
         try:
-            results = await asyncio.wait_for(
-                loop.run_in_executor(download_executor, search_youtube_music, query),
-                timeout=SEARCH_TIMEOUT
-            )
+            results = await executors['search'].run(search_youtube_music, query)
         except asyncio.TimeoutError:
             await search_msg.edit_text("❌ Поиск занял слишком много времени. Попробуйте позже.")
             return ConversationHandler.END
+        except ExecutorBusyError:
+            await search_msg.edit_text("❌ Сейчас слишком много запросов на поиск. Попробуйте позже.")
+            return ConversationHandler.END
 
         if not results:
             await search_msg.edit_text("❌ По вашему запросу ничего не найдено.")
@@ -1840,7 +4285,7 @@ async def handle_search_result(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text(f"⏳ Получаю информацию о треке...")
 
         try:
-            info = get_video_info(url, 'youtube')
+            info = await metadata_service.video_info(url, 'youtube')
             formats = info.get('formats', [])
 
             if not formats:
@@ -1865,7 +4310,6 @@ async def handle_search_result(update: Update, context: ContextTypes.DEFAULT_TYP
 
             user_videos[user_id] = {
                 'url': url,
-                'formats': formats,
                 'url_type': 'youtube',
                 'title': title,
                 'duration': duration
@@ -1895,28 +4339,108 @@ async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # Команда /queue
+def format_eta(seconds):
+    """Форматирует прогноз времени как м:сс или ч:мм:сс"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
 async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /queue для просмотра статуса очереди"""
     user_id = update.effective_user.id
 
-    if download_queue.empty():
+    queued_jobs = download_queue.jobs_for_user(user_id)
+    running_jobs = download_queue.running_for_user(user_id)
+
+    if download_queue.empty() and not running_jobs:
         await update.message.reply_text("📋 Очередь загрузок пуста.")
+        return
+
+    if not queued_jobs and not running_jobs:
+        await update.message.reply_text(f"📋 У вас нет активных заданий в очереди.\nВсего заданий в очереди: {download_queue.qsize()}")
+        return
+
+    # Порядок выдачи считается один раз на всю команду
+    order = download_queue.dispatch_order()
+    positions = download_queue.positions(order)
+    finish_times = download_queue.estimate_finish_times(order)
+    lines = ["📋 Ваши задания:"]
+    for job in running_jobs:
+        state_text = JOB_STATE_LABELS[job.state]
+        if job.state == JOB_DOWNLOADING and job.total_bytes:
+            state_text += f" {job.downloaded_bytes * 100 / job.total_bytes:.0f}%"
+        lines.append(f"⏳ #{job.job_id}: {state_text}, осталось ~{format_eta(finish_times[job.job_id])}")
+    for job in queued_jobs:
+        lines.append(
+            f"🕒 #{job.job_id}: позиция {positions[job.job_id]}, "
+            f"готово через ~{format_eta(finish_times[job.job_id])}"
+        )
+    lines.append(f"\nВсего заданий в очереди: {download_queue.qsize()}")
+    await update.message.reply_text("\n".join(lines))
+
+# Команда /cancel
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /cancel: отменяет все загрузки пользователя или одну по номеру из /queue"""
+    user_id = update.effective_user.id
+
+    if context.args:
+        try:
+            job_ids = [int(context.args[0].lstrip('#'))]
+        except ValueError:
+            await update.message.reply_text("❌ Укажите номер задания из /queue, например: /cancel 12")
+            return
     else:
-        position = queue_status.get(user_id, 0)
-        if position > 0:
-            await update.message.reply_text(f"📋 Ваша позиция в очереди: {position}\nВсего заданий в очереди: {download_queue.qsize()}")
-        else:
-            await update.message.reply_text(f"📋 У вас нет активных заданий в очереди.\nВсего заданий в очереди: {download_queue.qsize()}")
+        job_ids = [job.job_id for job in download_queue.running_for_user(user_id)]
+        job_ids += [job.job_id for job in download_queue.jobs_for_user(user_id)]
+
+    cancelled = await cancel_user_jobs(context.application, user_id, job_ids)
+    if cancelled:
+        await update.message.reply_text(f"❌ Отменено заданий: {cancelled}")
+    else:
+        await update.message.reply_text("📋 У вас нет заданий, которые можно отменить.")
+
+async def handle_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопки отмены на сообщении о загрузке"""
+    query = update.callback_query
+    job_id = int(query.data.split(':')[1])
+
+    if await cancel_user_jobs(context.application, query.from_user.id, [job_id]):
+        await query.answer("Загрузка отменена")
+    else:
+        await query.answer("Задание уже завершено или запрошено другим пользователем")
 
 class DownloadProgress:
-    def __init__(self, message, max_size=50*1024*1024):
+    def __init__(self, message, max_size=50*1024*1024, job=None, reply_markup=None):
         self.message = message
         self.max_size = max_size
         self.last_update = 0
         self.start_time = time.time()
         self.loop = None
+        self.job = job
+        self.reply_markup = reply_markup
+        # Байты уже скачанных файлов (видео и аудио могут скачиваться отдельно)
+        self.finished_bytes = 0
 
     def progress_hook(self, d):
+        job = self.job
+        # Отмена: исключение из хука прерывает загрузку yt-dlp, частичные файлы удаляет обработчик очереди
+        if job and job.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Загрузка отменена пользователем")
+
+        if job:
+            if d['status'] == 'downloading':
+                job.set_state(JOB_DOWNLOADING)
+                job.downloaded_bytes = self.finished_bytes + d.get('downloaded_bytes', 0)
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    job.total_bytes = self.finished_bytes + total
+            elif d['status'] == 'finished':
+                self.finished_bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                job.downloaded_bytes = self.finished_bytes
+                job.set_state(JOB_POSTPROCESSING)
+
         if d['status'] == 'downloading':
             # Получаем информацию о прогрессе
             total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
@@ -1951,7 +4475,7 @@ class DownloadProgress:
 
                 try:
                     # Используем asyncio для планирования задачи в основном потоке
-                    if self.loop:
+                    if self.loop and self.message:
                         asyncio.run_coroutine_threadsafe(self.update_message(status_text), self.loop)
                 except:
                     pass
@@ -1964,7 +4488,7 @@ class DownloadProgress:
 
     async def update_message(self, text):
         try:
-            await self.message.edit_text(text)
+            await self.message.edit_text(text, reply_markup=self.reply_markup)
         except Exception as e:
             logger.debug(f"Не удалось обновить сообщение прогресса: {e}")
 
@@ -2040,7 +4564,7 @@ async def handle_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text("⏳ Получаю информацию о видео...")
 
             try:
-                info = get_video_info(url, url_type)
+                info = await metadata_service.video_info(url, url_type)
                 formats = info.get('formats', [])
 
                 if not formats:
@@ -2049,19 +4573,8 @@ async def handle_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
 
                 # Для TikTok добавляем в очередь
                 if url_type == 'tiktok':
-                    task = (user_id, url, "best", None, url_type, query.message, True)
-                    await download_queue.put(task)
-
-                    update_queue_positions()
-
-                    position = queue_status.get(user_id, 0)
-                    if position > 0:
-                        await query.edit_message_text(f"📋 Ваш запрос добавлен в очередь. Позиция: {position}")
-                    else:
-                        await query.edit_message_text("📋 Ваш запрос добавлен в очередь.")
-
-                    if not queue_processing:
-                        asyncio.create_task(process_download_queue(context.application))
+                    task = DownloadTask(user_id, url, "best", None, url_type, query.message, True)
+                    await enqueue_download(task, query.edit_message_text, "📋 Ваш запрос добавлен в очередь.")
                     return
 
                 # Для YouTube и YouTube Music показываем выбор качества
@@ -2093,7 +4606,6 @@ async def handle_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
                 # Сохраняем информацию о видео для пользователя
                 user_videos[user_id] = {
                     'url': url,
-                    'formats': formats,
                     'url_type': url_type,
                     'title': title,
                     'duration': duration
@@ -2107,22 +4619,8 @@ async def handle_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
         elif action == "audio_inline":
             # Обработка аудио из inline-запроса
             # Добавляем задание в очередь
-            task = (user_id, url, "audio", None, url_type, query.message, True)
-            await download_queue.put(task)
-
-            # Обновляем позиции в очереди
-            update_queue_positions()
-
-            # Сообщаем пользователю о позиции в очереди
-            position = queue_status.get(user_id, 0)
-            if position > 0:
-                await query.edit_message_text(f"📋 Ваш запрос на аудио добавлен в очередь. Позиция: {position}")
-            else:
-                await query.edit_message_text("📋 Ваш запрос на аудио добавлен в очередь.")
-
-            # Запускаем обработку очереди, если она не активна
-            if not queue_processing:
-                asyncio.create_task(process_download_queue(context.application))
+            task = DownloadTask(user_id, url, "audio", None, url_type, query.message, True)
+            await enqueue_download(task, query.edit_message_text, "📋 Ваш запрос на аудио добавлен в очередь.")
 
     except Exception as e:
         logger.error(f"Ошибка в обработке inline callback: {e}")
@@ -2146,7 +4644,7 @@ async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Получаем информацию о видео
         try:
-            info = get_video_info(query, url_type)
+            info = await metadata_service.video_info(query, url_type)
             title = info.get('title', 'Видео')
             thumbnail = info.get('thumbnail', '')
             duration = info.get('duration', 0)
@@ -2270,7 +4768,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_msg = await update.message.reply_text("⏳ Получаю информацию о видео...")
 
         try:
-            info = get_video_info(text, url_type)
+            info = await metadata_service.video_info(text, url_type)
             formats = info.get('formats', [])
 
             if not formats:
@@ -2280,22 +4778,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Для TikTok добавляем в очередь
             if url_type == 'tiktok':
                 # Добавляем задание в очередь
-                task = (user_id, text, "best", None, url_type, status_msg, False)
-                await download_queue.put(task)
-
-                # Обновляем позиции в очереди
-                update_queue_positions()
-
-                # Сообщаем пользователю о позиции в очереди
-                position = queue_status.get(user_id, 0)
-                if position > 0:
-                    await status_msg.edit_text(f"📋 Ваш TikTok запрос добавлен в очередь. Позиция: {position}")
-                else:
-                    await status_msg.edit_text("📋 Ваш TikTok запрос добавлен в очередь.")
-
-                # Запускаем обработку очереди, если она не активна
-                if not queue_processing:
-                    asyncio.create_task(process_download_queue(context.application))
+                task = DownloadTask(user_id, text, "best", None, url_type, status_msg, False)
+                await enqueue_download(task, status_msg.edit_text, "📋 Ваш TikTok запрос добавлен в очередь.")
                 return
 
 
@@ -2321,7 +4805,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             user_videos[user_id] = {
                 'url': text,
-                'formats': formats,
                 'url_type': url_type,
                 'title': title,
                 'duration': duration
@@ -2406,46 +4889,36 @@ async def handle_cache_selection(update: Update, context: ContextTypes.DEFAULT_T
                 return
 
             cache_data = cached_versions[cache_index]
-            file_path = cache_data['file_path']
 
-            if not os.path.exists(file_path):
+            if not is_cache_entry_available(cache_data):
                 await query.edit_message_text("❌ Кэшированный файл больше не существует.")
                 return
 
             await query.edit_message_text("📤 Отправляю кэшированное видео...")
 
-            # Отправляем файл
-            is_audio = file_path.endswith(('.mp3', '.m4a', '.ogg', '.wav'))
-            title = cache_data.get('title', 'Video')
+            # Отправляем по file_id, а при его отказе — из локального файла
+            file_path = cache_data.get('file_path') or ''
+            is_audio = cache_data.get('media_type') == 'audio' or file_path.endswith(AUDIO_EXTENSIONS)
+            title = cache_data.get('title') or 'Video'
             source_text = "YouTube Music" if cache_data.get('url_type') == "youtube_music" else "YouTube"
+            if is_audio:
+                caption = f"🎵 {title} (из кэша)"
+            else:
+                caption = f"🎥 {title} (из кэша)\n📺 Источник: {source_text}"
 
             try:
-                with open(file_path, 'rb') as file:
-                    if is_audio:
-                        await asyncio.wait_for(
-                            context.bot.send_audio(
-                                chat_id=query.message.chat_id,
-                                audio=file,
-                                caption=f"🎵 {title} (из кэша)",
-                                title=title[:30] + "..." if len(title) > 30 else title,
-                                performer=source_text
-                            ),
-                            timeout=SEND_FILE_TIMEOUT
-                        )
-                    else:
-                        await asyncio.wait_for(
-                            context.bot.send_video(
-                                chat_id=query.message.chat_id,
-                                video=file,
-                                caption=f"🎥 {title} (из кэша)\n📺 Источник: {source_text}",
-                                supports_streaming=True
-                            ),
-                            timeout=SEND_FILE_TIMEOUT
-                        )
+                sent_message = await send_cached_media(
+                    context.bot, query.message.chat_id, cache_data, caption, source_text
+                )
             except asyncio.TimeoutError:
                 await query.edit_message_text("❌ Таймаут при отправке файла. Пожалуйста, попробуйте позже.")
                 return
 
+            if not sent_message:
+                await query.edit_message_text("❌ Кэшированный файл больше не существует.")
+                return
+
+            user_videos.pop(user_id, None)
             if is_inline:
                 await query.delete()
             else:
@@ -2456,7 +4929,7 @@ async def handle_cache_selection(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text("⏳ Получаю информацию о видео...")
 
             try:
-                info = get_video_info(url, url_type)
+                info = await metadata_service.video_info(url, url_type)
                 formats = info.get('formats', [])
 
                 if not formats:
@@ -2466,22 +4939,8 @@ async def handle_cache_selection(update: Update, context: ContextTypes.DEFAULT_T
 
                 if url_type == 'tiktok':
 
-                    task = (user_id, url, "best", None, url_type, query.message, is_inline)
-                    await download_queue.put(task)
-
-
-                    update_queue_positions()
-
-
-                    position = queue_status.get(user_id, 0)
-                    if position > 0:
-                        await query.edit_message_text(f"📋 Ваш запрос добавлен в очередь. Позиция: {position}")
-                    else:
-                        await query.edit_message_text("📋 Ваш запрос добавлен в очередь.")
-
-
-                    if not queue_processing:
-                        asyncio.create_task(process_download_queue(context.application))
+                    task = DownloadTask(user_id, url, "best", None, url_type, query.message, is_inline)
+                    await enqueue_download(task, query.edit_message_text, "📋 Ваш запрос добавлен в очередь.")
                     return
 
 
@@ -2507,7 +4966,6 @@ async def handle_cache_selection(update: Update, context: ContextTypes.DEFAULT_T
                 # Сохраняем информацию о видео для пользователя
                 user_videos[user_id] = {
                     'url': url,
-                    'formats': formats,
                     'url_type': url_type,
                     'title': title,
                     'duration': duration
@@ -2557,22 +5015,10 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
         url_type = video_info.get('url_type', 'youtube')
 
         # Добавляем задание в очередь
-        task = (user_id, url, format_type, format_id, url_type, query.message, is_inline)
-        await download_queue.put(task)
-
-        # Обновляем позиции в очереди
-        update_queue_positions()
-
-        # Сообщаем пользователю о позиции в очереди
-        position = queue_status.get(user_id, 0)
-        if position > 0:
-            await query.edit_message_text(f"📋 Ваш запрос добавлен в очередь. Позиция: {position}")
-        else:
-            await query.edit_message_text("📋 Ваш запрос добавлен в очередь.")
-
-        # Запускаем обработку очереди, если она не активна
-        if not queue_processing:
-            asyncio.create_task(process_download_queue(context.application))
+        task = DownloadTask(user_id, url, format_type, format_id, url_type, query.message, is_inline)
+        if await enqueue_download(task, query.edit_message_text, "📋 Ваш запрос добавлен в очередь."):
+            # Выбор сделан; при отказе очереди запись остается, чтобы выбрать еще раз
+            user_videos.pop(user_id, None)
 
     except Exception as e:
         logger.error(f"Ошибка в обработке выбора качества: {e}")
@@ -2589,20 +5035,19 @@ async def clear_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
 
         # Очищаем кэш
-        video_cache = load_video_cache()
         cache_size = 0
         deleted_files = 0
 
-        for url_hash, cache_data in video_cache.items():
-            file_path = cache_data.get('file_path', '')
+        for cache_data in video_cache_store.all_entries():
+            file_path = cache_data.get('file_path') or ''
             if os.path.exists(file_path):
                 file_size = os.path.getsize(file_path)
                 cache_size += file_size
                 os.remove(file_path)
                 deleted_files += 1
 
-        # Очищаем файл кэша
-        save_video_cache({})
+        # Очищаем базу кэша
+        video_cache_store.clear()
 
         await update.message.reply_text(
             f"✅ Кэш очищен!\n"
@@ -2613,12 +5058,51 @@ async def clear_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Ошибка в команде /clear_cache: {e}")
         logger.error(traceback.format_exc())
 
+# Команда /cache_usage - заполнение кэша относительно квоты (только для админа)
+async def cache_usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user_id = update.effective_user.id
+        if str(user_id) != str(ADMIN_ID):
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        used_bytes, used_entries = video_cache_store.usage()
+        max_bytes_text = f"{CACHE_MAX_BYTES//1024//1024} МБ" if CACHE_MAX_BYTES else "без ограничения"
+        max_entries_text = str(CACHE_MAX_ENTRIES) if CACHE_MAX_ENTRIES else "без ограничения"
+
+        await update.message.reply_text(
+            f"📦 Использование кэша:\n\n"
+            f"• Размер: {used_bytes//1024//1024} МБ из {max_bytes_text}\n"
+            f"• Файлов: {used_entries} из {max_entries_text}\n"
+            f"• Политика вытеснения: {CACHE_EVICTION_POLICY}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в команде /cache_usage: {e}")
+        logger.error(traceback.format_exc())
+
+async def stop_background_tasks(application):
+    """Останавливает фоновые задачи и закрывает HTTP-клиенты, пока цикл событий еще работает"""
+    tasks = background_tasks + list(download_workers.values())
+    for task in tasks:
+        task.cancel()
+    # Потоки загрузок прерываются на следующем progress_hook, а не докачивают брошенные задания
+    for job in download_queue.running.values():
+        job.cancel_event.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await feed_client.close()
+
 def main():
 
     load_user_data()
+    load_video_cache()
     load_subscriptions()
+    load_channel_state()
+    load_download_queue()
 
-    application = Application.builder().token(BOT_TOKEN).read_timeout(30).write_timeout(30).connect_timeout(30).build()
+    application = (
+        Application.builder().token(BOT_TOKEN).read_timeout(30).write_timeout(30).connect_timeout(30)
+        .post_shutdown(stop_background_tasks).build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -2626,7 +5110,9 @@ def main():
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("audio", audio_command))
     application.add_handler(CommandHandler("clear_cache", clear_cache_command))
+    application.add_handler(CommandHandler("cache_usage", cache_usage_command))
     application.add_handler(CommandHandler("queue", queue_command))
+    application.add_handler(CommandHandler("limits", limits_command))
 
 
     application.add_handler(CommandHandler("subscribe", subscribe_command))
@@ -2650,6 +5136,9 @@ def main():
         fallbacks=[CommandHandler('cancel', cancel_search)]
     )
     application.add_handler(search_handler)
+    # После диалога поиска: внутри него /cancel отменяет поиск
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CallbackQueryHandler(handle_cancel_callback, pattern="^cancel_dl:"))
 
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -2672,16 +5161,13 @@ def main():
 
     logger.info("Бот запущен...")
 
-    async def start_subscription_tasks(app):
-            for user_id in subscriptions.keys():
-                if user_id not in subscription_tasks:
-                    subscription_tasks[user_id] = asyncio.create_task(
-                        check_subscriptions_for_user(user_id, app)
-                    )
-
     try:
         loop = asyncio.get_event_loop()
-        loop.create_task(start_subscription_tasks(application))
+        state_persister.start(loop)
+        background_tasks.append(loop.create_task(subscription_poller.run(application)))
+        background_tasks.append(loop.create_task(cache_reaper()))
+        background_tasks.append(loop.create_task(start_download_workers(application)))
+        # run_polling сам обрабатывает SIGINT/SIGTERM и вызывает stop_background_tasks
         application.run_polling(
             poll_interval=1.0,
             timeout=10,
@@ -2690,18 +5176,16 @@ def main():
         )
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
-
-        for task in subscription_tasks.values():
-            task.cancel()
-
-        download_executor.shutdown(wait=True)
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
         logger.error(traceback.format_exc())
-
-        for task in subscription_tasks.values():
-            task.cancel()
-        download_executor.shutdown(wait=True)
+    finally:
+        # Не ждем брошенных вызовов: задания загрузок уже отменены и останутся в журнале
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        ydl_pool.close_all()
+        # Сохраняем все несохраненные изменения перед выходом
+        state_persister.stop()
 
 
 